@@ -8,23 +8,27 @@ least on MacOS. When the app is invoked from the terminal via "open", or
 app.py is run with  "python app.py", the working directory is the shell's
 current directory.
 
+For a fast start, export_things (with sqlite3, multiprocessing etc.) and the
+file dialog are imported when they are first needed, and the window is
+brought to the front after it is shown. Set T2TP_STARTUP_BENCHMARK to quit
+right after the first frame (see benchmark.py --startup).
 """
 
-from argparse import Namespace
+import collections
 import logging
 import os
 from pathlib import Path
 import queue
+import subprocess
+import sys
 from textwrap import dedent
+import threading
 import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
-from tkinter import filedialog
 from tkinter import ttk
 
 import traceback
 
-import export_things
-
 # from setup import VERSION
 VERSION = '1.0.2'
 
@@ -34,6 +38,8 @@ logger = logging.getLogger("t2tp")
 DATABASE_DIR = '~/Library/Group Containers/JLMPQHK86H.com.culturedcode.ThingsMac/Things Database.thingsdatabase/'
 DATABASE_NAME = 'main.sqlite'
 DEFAULT_TARGET = 'Things 3 export'
+PROFILE_NAME = 'things2taskpaper-profile.json'
+STARTUP_BENCHMARK_ENV = 'T2TP_STARTUP_BENCHMARK'
 
 BG_COL_1 = "#524790"
 TEXT_COL = '#4a4a7c'
@@ -52,14 +58,20 @@ class App:
         Export your data from the Things 3 database to TaskPaper files.
     """)
     EXPLANATION_TEXT = dedent("""\
-        Please close Things 3 before exporting the database!
+        Things 3 can stay open, the export works on a copy of the database.
         You will find all exported data in your Downloads folder.
     """)
 
     def __init__(self, master):
 
         self.source_type = None
-        master.geometry('600x600')
+        self.master = master
+        self.export_thread = None
+        self.progress = None
+        self.profile = False
+        # hidden toggle for profiling the export
+        master.bind('<Control-P>', self.cmd_toggle_profile)
+        master.geometry('600x750')
         self.setup_styles()
         self.build_gui(master)
 
@@ -98,8 +110,12 @@ class App:
         ff.pack(anchor=tk.NW, padx=10, pady=5)
         self.output_format_frame(ff, self.LABEL_TARGET_FORMAT, self.format, self.FMT_AREA[1], self.FORMATS)
 
-        export = ttk.Button(upper_frame, text="EXPORT", command=self.cmd_things2tp, style="Export.TButton")
-        export.pack(anchor=tk.NW, side=tk.LEFT, padx=10, pady=5)
+        self.export_button = ttk.Button(upper_frame, text="EXPORT", command=self.cmd_things2tp, style="Export.TButton")
+        self.export_button.pack(anchor=tk.NW, side=tk.LEFT, padx=10, pady=5)
+
+        self.cancel_button = ttk.Button(upper_frame, text="CANCEL", command=self.cmd_cancel, style='Quit.TButton')
+        self.cancel_button.pack(anchor=tk.NW, side=tk.LEFT, padx=5, pady=5)
+        self.cancel_button.state(['disabled'])
 
         quit = ttk.Button(upper_frame, text="QUIT", command=master.quit, style='Quit.TButton')
         quit.pack(anchor=tk.NE, side=tk.RIGHT, padx=5, pady=5)
@@ -115,7 +131,10 @@ class App:
 
         logger_frame = ttk.LabelFrame(container, text="Exporter Output:")
         logger_frame.pack(anchor=tk.NW, fill=tk.X, padx=10, pady=10)
-        self.console = ConsoleUi(logger_frame, container)
+        progress_frame = ttk.Frame(logger_frame)
+        progress_frame.pack(anchor=tk.NW, fill=tk.X, padx=0, pady=0)
+        self.progress_ui = ProgressUi(progress_frame)
+        self.console = ConsoleUi(logger_frame, container, self.progress_ui)
 
     def more_options_frame(self, frame):
         # source file
@@ -136,6 +155,24 @@ class App:
         ttk.Entry(source_frame, text="foobar", textvariable=self.filename).pack(side=tk.LEFT)
         ttk.Button(source_frame, text="Select File", command=self.cb_select_file).pack(side=tk.LEFT)
 
+        # selection (comma separated lists, empty for everything)
+        self.areas = tk.StringVar()
+        self.projects = tk.StringVar()
+        self.inbox_only = tk.BooleanVar()
+        self.tags = tk.StringVar()
+        self.modified_since = tk.StringVar()
+        selection_frame = ttk.Frame(frame)
+        selection_frame.pack(anchor=tk.NW, padx=0, pady=5)
+        ttk.Label(selection_frame, text="Only export areas:").grid(row=0, column=0, sticky=tk.W)
+        ttk.Entry(selection_frame, textvariable=self.areas).grid(row=0, column=1, sticky=tk.W)
+        ttk.Label(selection_frame, text="projects:").grid(row=0, column=2, sticky=tk.W)
+        ttk.Entry(selection_frame, textvariable=self.projects).grid(row=0, column=3, sticky=tk.W)
+        ttk.Checkbutton(selection_frame, text="the inbox", variable=self.inbox_only).grid(row=1, column=1, sticky=tk.W)
+        ttk.Label(selection_frame, text="Only export tasks with tags:").grid(row=2, column=0, sticky=tk.W)
+        ttk.Entry(selection_frame, textvariable=self.tags).grid(row=2, column=1, sticky=tk.W)
+        ttk.Label(selection_frame, text="modified since:").grid(row=2, column=2, sticky=tk.W)
+        ttk.Entry(selection_frame, textvariable=self.modified_since, width=10).grid(row=2, column=3, sticky=tk.W)
+
     def output_format_frame(self, frame, label, variable, default, available_formats):
         """Set available output formats."""
         variable.set(default)
@@ -143,12 +180,17 @@ class App:
         for text, mode in available_formats:
             ttk.Radiobutton(frame, text=text, variable=variable, value=mode).pack(side=tk.LEFT)
 
+    @staticmethod
+    def split_list(text):
+        return [item.strip() for item in text.split(',') if item.strip()]
+
     def clean_frame(self, frame):
         for widget in frame.winfo_children():
             widget.destroy()
 
     def cb_select_file(self):
-        filename = tk.filedialog.askopenfilename(initialdir=os.path.join(Path.home(), "Documents"),
+        from tkinter import filedialog
+        filename = filedialog.askopenfilename(initialdir=os.path.join(Path.home(), "Documents"),
                                                  title="Select file",
                                                  defaultextension='*.sqlite3',
                                                  filetypes=(("SQLite3 Files", "*.sqlite3"),
@@ -157,6 +199,10 @@ class App:
 
     def cmd_things2tp(self):
         """Export the database. This is called when pressing the Export button"""
+        if self.export_thread is not None and self.export_thread.is_alive():
+            return
+        from argparse import Namespace
+        import export_things
         logger.setLevel('INFO')
         # logger.setLevel('DEBUG')
         logger.info("starting conversion...")
@@ -180,7 +226,7 @@ class App:
         target = self.output_file.get()
         if not target:
             target = DEFAULT_TARGET
-        # capture stdout if all-in-one
+        # single output file if all-in-one
         if output_format == self.FMT_ALL[1]:
             target = export_things.RowObject.FILE_TMPL % target
         target = os.path.join(Path.home(), "Downloads", target)
@@ -190,9 +236,35 @@ class App:
                          target=target,
                          format=output_format,
                          stdout=False,
+                         snapshot=export_things.SNAPSHOT_FILE,
+                         areas=self.split_list(self.areas.get()),
+                         projects=self.split_list(self.projects.get()),
+                         inbox_only=self.inbox_only.get(),
+                         tags=self.split_list(self.tags.get()),
+                         modified_since=self.modified_since.get().strip() or None,
                          called_from_gui=True)
+        if self.profile:
+            args.profile = os.path.join(Path.home(), "Downloads", PROFILE_NAME)
+        # run the export in a worker thread, which talks to the GUI only through the logger
+        self.progress = export_things.Progress(report=self.report_progress)
+        self.progress_ui.reset()
+        self.export_thread = threading.Thread(target=self.run_export, args=(args, self.progress), daemon=True)
+        self.export_button.state(['disabled'])
+        self.cancel_button.state(['!disabled'])
+        self.export_thread.start()
+        self.master.after(100, self.check_export_thread)
+
+    def run_export(self, args, progress):
+        """Run the export (in the worker thread)."""
+        import export_things
         try:
-            export_things.export(args)
+            report = export_things.export(args, progress=progress)
+            if report:
+                for line in export_things.Profiler.summary(report):
+                    logger.info(line)
+                logger.info("profile: report written to %s" % args.profile)
+        except export_things.ExportCancelled:
+            logger.warning("export cancelled")
         except Exception:
             tb = traceback.format_exc()
             logger.error(tb)
@@ -201,6 +273,29 @@ class App:
 
         logger.info("ready")
 
+    def report_progress(self, snapshot):
+        """Send a progress snapshot to the GUI (called in the worker thread)."""
+        logger.info("progress", extra=dict(progress=snapshot))
+
+    def check_export_thread(self):
+        if self.export_thread.is_alive():
+            self.master.after(100, self.check_export_thread)
+        else:
+            self.export_button.state(['!disabled'])
+            self.cancel_button.state(['disabled'])
+
+    def cmd_toggle_profile(self, event=None):
+        """Switch profiling of the export on or off. This is called when pressing Ctrl-Shift-P"""
+        self.profile = not self.profile
+        logger.setLevel('INFO')
+        logger.info("profiling %s" % ("on" if self.profile else "off"))
+
+    def cmd_cancel(self):
+        """Cancel a running export. This is called when pressing the Cancel button"""
+        if self.export_thread is not None and self.export_thread.is_alive():
+            logger.info("cancelling export...")
+            self.progress.cancel()
+
 
 class QueueHandler(logging.Handler):
     """Class to send logging records to a queue
@@ -215,11 +310,46 @@ class QueueHandler(logging.Handler):
         self.log_queue.put(record)
 
 
+class ProgressUi:
+    """Display progress snapshots of the export: a progress bar and a line with counts, throughput and ETA"""
+
+    def __init__(self, frame):
+        self.bar = ttk.Progressbar(frame, mode='determinate', maximum=1)
+        self.bar.pack(fill=tk.X, padx=0, pady=5)
+        self.text = tk.StringVar()
+        ttk.Label(frame, textvariable=self.text, font='TkFixedFont').pack(anchor=tk.NW)
+
+    def reset(self):
+        self.bar.configure(maximum=1, value=0)
+        self.text.set('')
+
+    def display(self, snapshot):
+        done = snapshot['done']
+        total = snapshot['total']
+        self.bar.configure(maximum=max(total['tasks'], 1), value=done['tasks'])
+        if snapshot['eta'] is None:
+            eta = '-'
+        else:
+            eta = '%d:%02d' % divmod(int(snapshot['eta']), 60)
+        self.text.set("areas %d/%d  projects %d/%d  tasks %d/%d  %.0f tasks/s  ETA %s" % (
+            done['areas'], total['areas'], done['projects'], total['projects'],
+            done['tasks'], total['tasks'], snapshot['tasks_per_second'], eta))
+
+
 class ConsoleUi:
-    """Poll messages from a logging queue and display them in a scrolled text widget"""
+    """Poll messages from a logging queue and display them in a scrolled text widget
 
-    def __init__(self, frame, master):
+    All messages that arrived since the last poll are inserted at once, and
+    only the last MAX_LINES lines are kept, so a flood of (debug) messages
+    doesn't slow down the GUI or fill up the memory.
+    """
+
+    POLL_INTERVAL = 100  # ms
+    MAX_LINES = 5000
+
+    def __init__(self, frame, master, progress_ui=None):
         self.frame = frame
+        self.progress_ui = progress_ui
         # Create a ScrolledText wdiget
         self.scrolled_text = ScrolledText(frame, state='disabled', height=12, background="#E8E8E8")
         self.scrolled_text.grid(row=0, column=0, sticky=(tk.N, tk.S, tk.W, tk.E))
@@ -236,27 +366,49 @@ class ConsoleUi:
         self.queue_handler.setFormatter(formatter)
         logger.addHandler(self.queue_handler)
         # Start polling messages from the queue
-        self.frame.after(100, self.poll_log_queue)
+        self.frame.after(self.POLL_INTERVAL, self.poll_log_queue)
         self.scrolled_text.pack(fill=tk.BOTH, expand=1)
 
-    def display(self, record):
-        msg = self.queue_handler.format(record)
+    def display(self, records):
+        # one insert with a (text, tag) pair per message
+        chunks = []
+        for record in records:
+            chunks.extend((self.queue_handler.format(record) + '\n', record.levelname))
         self.scrolled_text.configure(state='normal')
-        self.scrolled_text.insert(tk.END, msg + '\n', record.levelname)
+        self.scrolled_text.insert(tk.END, *chunks)
+        lines = int(self.scrolled_text.index('end-1c').split('.')[0]) - 1  # the text ends with a newline
+        if lines > self.MAX_LINES:
+            self.scrolled_text.delete('1.0', '%d.0' % (lines - self.MAX_LINES + 1))
         self.scrolled_text.configure(state='disabled')
         # Autoscroll to the bottom
         self.scrolled_text.yview(tk.END)
 
     def poll_log_queue(self):
-        # Check every 100ms if there is a new message in the queue to display
+        # Check every 100ms for new messages in the queue, only the latest progress snapshot is shown
+        records = collections.deque(maxlen=self.MAX_LINES)
+        progress = None
         while True:
             try:
                 record = self.log_queue.get(block=False)
             except queue.Empty:
                 break
             else:
-                self.display(record)
-        self.frame.after(100, self.poll_log_queue)
+                snapshot = getattr(record, 'progress', None)
+                if snapshot is None:
+                    records.append(record)
+                else:
+                    progress = snapshot
+        if records:
+            self.display(records)
+        if progress is not None and self.progress_ui is not None:
+            self.progress_ui.display(progress)
+        self.frame.after(self.POLL_INTERVAL, self.poll_log_queue)
+
+
+def bring_to_front():
+    if sys.platform == 'darwin':
+        subprocess.Popen(['/usr/bin/osascript', '-e', 'tell app "Finder" to set frontmost of process "python" to true'],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
 def main():
@@ -272,10 +424,15 @@ def main():
         h = int(b[1])
         root.geometry('%dx%d' % (w + 1, h + 1))
     root.update()
+    if os.environ.get(STARTUP_BENCHMARK_ENV):
+        print("first frame", flush=True)
+        root.destroy()
+        return
     root.after(0, fix_macos_mojave_button_issue)
     # end of workaround code
 
-    os.system('''/usr/bin/osascript -e 'tell app "Finder" to set frontmost of process "python" to true' ''')
+    # bring the window to the front, without waiting for osascript
+    root.after_idle(bring_to_front)
     root.mainloop()
     root.destroy()
 
@@ -0,0 +1,341 @@
+import argparse
+from argparse import Namespace
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import export_things
+import generate_testdb
+
+"""
+Benchmark export_things.export() on generated databases.
+
+For every database, format and engine the export runs in a fresh process,
+which reports wall time, the number of SQL statements executed and its peak
+RSS. Before measuring, the test database is exported and compared to
+test-data/test-database-export.taskpaper, so a fast but wrong exporter
+doesn't go unnoticed.
+
+Results are appended to a JSON file (default: benchmark.json), one entry per
+run with the git commit, so runs can be compared across commits.
+
+With --notes, it instead times the rendering of large generated notes, with
+and without links, against the former line-by-line renderer. With
+--statements, it times the per-node queries of --engine query for every node
+of the databases, with the uuid bound as a parameter (one prepared statement)
+and interpolated into the query text as before (prepared again for every node).
+With --startup, it times the start of the app up to its first frame (and
+of a packaged app with --app), and the imports of app and export_things.
+"""
+
+GOLDEN_DATABASE = 'test-data/Things-testdb.thingsdatabase/main.sqlite'
+GOLDEN_EXPORT = 'test-data/test-database-export.taskpaper'
+
+PRESETS = dict(
+    small=dict(areas=5, projects=5, headers=2, tasks=10),
+    medium=dict(areas=10, projects=10, headers=3, tasks=20),
+    large=dict(areas=20, projects=20, headers=3, tasks=40),
+)
+
+
+def check_golden():
+    """Export the test database and compare it to the golden file."""
+    target = export_things.MemoryTarget()
+    args = Namespace(database=GOLDEN_DATABASE, target='golden', format=export_things.RowObject.FMT_ALL,
+                     stdout=False, called_from_gui=True)
+    export_things.export(args, target)
+    with open(GOLDEN_EXPORT) as f:
+        return target.files['golden.taskpaper'].getvalue() == f.read()
+
+
+def generated_database(data_dir, preset, schema):
+    """Return the path of the database for preset and schema, generate it if necessary."""
+    path = os.path.join(data_dir, '%s-%s.sqlite' % (preset, schema))
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        print("generating", path)
+        generate_testdb.generate(generate_testdb.generator_args(target=path, schema=schema, **PRESETS[preset]))
+    return path
+
+
+def count_tasks(database):
+    con = sqlite3.connect(database)
+    count = con.execute("SELECT COUNT(*) FROM TMTask WHERE type != 1 AND trashed = 0 AND status < 2").fetchone()[0]
+    con.close()
+    return count
+
+
+def measure(database, fmt, engine, jobs):
+    """Export in a child process (for a clean peak RSS) and return its measurements."""
+    spec = dict(database=database, format=fmt, engine=engine, jobs=jobs)
+    output = subprocess.check_output([sys.executable, __file__, '--measure', json.dumps(spec)])
+    return json.loads(output)
+
+
+def measure_in_process(spec):
+    """Run one export with a statement counter on every connection, return the measurements."""
+    statements = [0]
+    connect = sqlite3.connect
+
+    def counting_connect(*args, **kwargs):
+        con = connect(*args, **kwargs)
+        con.set_trace_callback(lambda statement: statements.__setitem__(0, statements[0] + 1))
+        return con
+
+    sqlite3.connect = counting_connect
+    with tempfile.TemporaryDirectory() as tmp:
+        args = Namespace(database=spec['database'], target=os.path.join(tmp, 'export'), format=spec['format'],
+                         engine=spec['engine'], jobs=spec['jobs'], stdout=False, called_from_gui=True)
+        start = time.perf_counter()
+        export_things.export(args)
+        wall = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024  # bytes on macOS, kilobytes elsewhere
+    return dict(wall=wall, statements=statements[0], peak_rss_kb=peak_rss)
+
+
+NOTE_LENGTHS = (1000, 10000, 100000)
+NOTE_LINKS = dict(none=0, some=0.1, several=3)  # links per line, below 1 it's the share of lines with one link
+LEGACY_URL = re.compile(r"\<a href=\"(?P<url>.*)?\"\>.*?\<\/a\>")
+
+
+def generated_note(length, links, seed=0):
+    """Return a legacy note (wrapped, with html links) of about length characters."""
+    rnd = random.Random(seed)
+    lines = []
+    while sum(len(line) + 1 for line in lines) < length:
+        words = [rnd.choice(generate_testdb.WORDS) for _ in range(rnd.randint(3, 12))]
+        count = int(links) if links >= 1 else int(rnd.random() < links)
+        for _ in range(count):
+            url = rnd.choice(generate_testdb.URLS)
+            words.insert(rnd.randint(0, len(words)), '<a href="%s">%s</a>' % (url, url))
+        lines.append(' '.join(words))
+    return '<note xml:space="preserve">%s</note>' % '\n'.join(lines)
+
+
+def print_notes_by_line(node, out):
+    """The former renderer: one regex substitution and one write per line."""
+    notes = node.notes[27:-7]
+    for line in notes.split("\n"):
+        line = LEGACY_URL.sub(lambda m: m.group('url'), line)
+        out.writeline('%s%s' % (node.notes_indent, line))
+
+
+def benchmark_notes(args):
+    print("%-8s %-8s %12s %12s %8s" % ('length', 'links', 'by line (ms)', 'current (ms)', 'speedup'))
+    for length in NOTE_LENGTHS:
+        for name, links in NOTE_LINKS.items():
+            row = dict(export_things.Project.INBOX_ROW, notes=generated_note(length, links))
+            node = export_things.Task(row, None, None, 2)
+            times = []
+            for render in (print_notes_by_line, export_things.Task.print_notes):
+                number = max(1, 1000000 // length)
+                best = min(timeit.repeat(lambda: render(node, export_things.NullSink()),
+                                         number=number, repeat=args.repeat))
+                times.append(best / number * 1000)
+            print("%-8d %-8s %12.3f %12.3f %7.1fx" % (length, name, times[0], times[1], times[0] / times[1]))
+
+
+# per-node query, the query for the uuids of its nodes
+STATEMENT_QUERIES = (
+    ('RowObjectWithTags.TAGS_QUERY', export_things.RowObjectWithTags.TAGS_QUERY,
+     "SELECT uuid FROM TMTask WHERE trashed = 0 AND status < 2"),
+    ('Task.TASKS_IN_PROJECT', export_things.Task.TASKS_IN_PROJECT % '',
+     "SELECT uuid FROM TMTask WHERE type = 1 AND trashed = 0 AND status < 2"),
+    ('Task.TASKS_IN_ACTION_GROUPS', export_things.Task.TASKS_IN_ACTION_GROUPS % '',
+     "SELECT uuid FROM TMTask WHERE type = 2 AND trashed = 0 AND status < 2"),
+    ('CheckListItem.items_of_task', export_things.CheckListItem.items_of_task,
+     "SELECT uuid FROM TMTask WHERE checklistItemsCount > 0 AND trashed = 0 AND status < 2"),
+)
+
+
+def benchmark_statements(args):
+    print("%-30s %-32s %8s %18s %12s %8s" % ('database', 'query', 'nodes', 'interpolated (ms)', 'bound (ms)',
+                                              'speedup'))
+    for preset in args.presets.split(','):
+        if not preset:
+            continue
+        database = generated_database(args.data_dir, preset, generate_testdb.SCHEMA_CURRENT)
+        con = sqlite3.connect(database, cached_statements=export_things.CACHED_STATEMENTS)
+        for name, query, uuids_query in STATEMENT_QUERIES:
+            uuids = [row[0] for row in con.execute(uuids_query)]
+            literal = query.replace('?', "'%s'")  # the former templates
+
+            def interpolated():
+                for uuid in uuids:
+                    con.execute(literal % uuid).fetchall()
+
+            def bound():
+                for uuid in uuids:
+                    con.execute(query, (uuid,)).fetchall()
+
+            times = [min(timeit.repeat(run, number=1, repeat=args.repeat)) * 1000 for run in (interpolated, bound)]
+            print("%-30s %-32s %8d %18.1f %12.1f %7.1fx" % (database[-30:], name, len(uuids), times[0], times[1],
+                                                            times[0] / times[1]))
+        con.close()
+
+
+APP_STARTUP_ENV = 'T2TP_STARTUP_BENCHMARK'  # app.STARTUP_BENCHMARK_ENV, app isn't imported here
+
+
+def time_to_line(command, line, env=None):
+    """Run command, return the seconds until it prints line (None if it exits without)."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env,
+                               universal_newlines=True)
+    elapsed = None
+    for output in process.stdout:
+        if output.strip() == line:
+            elapsed = time.perf_counter() - start
+            break
+    process.stdout.close()
+    process.wait()
+    return elapsed
+
+
+def benchmark_startup(args):
+    env = dict(os.environ, **{APP_STARTUP_ENV: '1'})
+    commands = [
+        ('python', [sys.executable, '-c', 'print("ready")']),
+        ('import app', [sys.executable, '-c', 'import app; print("ready")']),
+        ('import export_things', [sys.executable, '-c', 'import export_things; print("ready")']),
+        ('app first frame', [sys.executable, 'app.py']),
+    ]
+    if args.app:
+        commands.append(('packaged app first frame', [args.app]))
+    results = {}
+    print("%-28s %12s" % ('startup', 'best (ms)'))
+    for name, command in commands:
+        line = 'first frame' if 'first frame' in name else 'ready'
+        times = [time_to_line(command, line, env) for _ in range(args.repeat)]
+        times = [t for t in times if t is not None]
+        results[name] = min(times) if times else None
+        print("%-28s %12s" % (name, '%.1f' % (results[name] * 1000) if times else 'failed (no display?)'))
+    save(args.output, dict(commit=git_commit(), date=datetime.now().isoformat(timespec='seconds'),
+                           python=platform.python_version(), platform=platform.platform(), startup=results))
+    print("results appended to", args.output)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(output, run):
+    runs = []
+    if os.path.exists(output):
+        with open(output) as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(output, 'w') as f:
+        json.dump(runs, f, indent=1)
+
+
+def benchmark(args):
+    golden = check_golden()
+    print("golden check:", "ok" if golden else "FAILED")
+    if not golden and not args.ignore_golden:
+        sys.exit("export differs from %s, not benchmarking" % GOLDEN_EXPORT)
+
+    databases = list(args.databases)
+    for preset in args.presets.split(','):
+        if preset:
+            for schema in args.schemas.split(','):
+                databases.append(generated_database(args.data_dir, preset, schema))
+
+    results = []
+    print("%-40s %-8s %-6s %8s %10s %10s %10s" % ('database', 'format', 'engine', 'tasks', 'wall (s)',
+                                                   'statements', 'RSS (MB)'))
+    for database in databases:
+        tasks = count_tasks(database)
+        for fmt in args.formats.split(','):
+            for engine in args.engines.split(','):
+                measurements = [measure(database, fmt, engine, args.jobs) for _ in range(args.repeat)]
+                best = min(measurements, key=lambda m: m['wall'])
+                result = dict(database=database, format=fmt, engine=engine, jobs=args.jobs, tasks=tasks,
+                              wall=best['wall'], statements=best['statements'],
+                              peak_rss_kb=max(m['peak_rss_kb'] for m in measurements))
+                results.append(result)
+                print("%-40s %-8s %-6s %8d %10.3f %10d %10.1f" % (
+                    database[-40:], fmt, engine, tasks, result['wall'], result['statements'],
+                    result['peak_rss_kb'] / 1024))
+
+    save(args.output, dict(commit=git_commit(), date=datetime.now().isoformat(timespec='seconds'),
+                           python=platform.python_version(), platform=platform.platform(),
+                           golden=golden, results=results))
+    print("results appended to", args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the Things 3 exporter on generated databases.')
+    parser.add_argument('--db', dest='databases', action='append',
+                        default=[],
+                        help='benchmark this database (may be given several times)')
+    parser.add_argument('--presets', dest='presets', action='store',
+                        default='small,medium',
+                        help='sizes of generated databases (%s), empty for none (default: small,medium)' %
+                             '|'.join(PRESETS))
+    parser.add_argument('--schemas', dest='schemas', action='store',
+                        default=generate_testdb.SCHEMA_CURRENT,
+                        help='schemas of generated databases (current|legacy) (default: current)')
+    parser.add_argument('--data-dir', dest='data_dir', action='store',
+                        default='bench-data',
+                        help='folder for generated databases, which are reused (default: bench-data)')
+    parser.add_argument('--formats', dest='formats', action='store',
+                        default='all,area,project',
+                        help='export formats to benchmark (default: all,area,project)')
+    parser.add_argument('--engines', dest='engines', action='store',
+                        default='bulk,query,tree',
+                        help='engines to benchmark (default: bulk,query,tree)')
+    parser.add_argument('--jobs', dest='jobs', action='store', type=int,
+                        default=1,
+                        help='worker processes for format area|project (default: 1)')
+    parser.add_argument('--repeat', dest='repeat', action='store', type=int,
+                        default=3,
+                        help='runs per measurement, the fastest one counts (default: 3)')
+    parser.add_argument('--output', dest='output', action='store',
+                        default='benchmark.json',
+                        help='JSON file the results are appended to (default: benchmark.json)')
+    parser.add_argument('--ignore-golden', dest='ignore_golden', action='store_true',
+                        default=False,
+                        help='benchmark even if the golden check fails')
+    parser.add_argument('--notes', dest='notes', action='store_true',
+                        default=False,
+                        help='time the rendering of large generated notes instead of exporting databases')
+    parser.add_argument('--statements', dest='statements', action='store_true',
+                        default=False,
+                        help='time the per-node queries with bound parameters against interpolated query texts')
+    parser.add_argument('--startup', dest='startup', action='store_true',
+                        default=False,
+                        help='time the start of the app up to its first frame and the imports, instead of exporting')
+    parser.add_argument('--app', dest='app', action='store',
+                        default=None,
+                        help='with --startup, also time this packaged app (e.g. dist/things2taskpaper/things2taskpaper)')
+    parser.add_argument('--measure', dest='measure', action='store',
+                        help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.measure:
+        print(json.dumps(measure_in_process(json.loads(args.measure))))
+    elif args.notes:
+        benchmark_notes(args)
+    elif args.statements:
+        benchmark_statements(args)
+    elif args.startup:
+        benchmark_startup(args)
+    else:
+        benchmark(args)
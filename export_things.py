@@ -1,10 +1,29 @@
 import argparse
+import contextlib
+import csv
 from datetime import datetime
+import filecmp
+import functools
+import glob
+import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
 import re
+import shutil
+import signal
 import sqlite3
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.parse import urlencode
+from urllib.request import pathname2url
+import zipfile
 
 """
 Export Things 3 database to TaskPaper files
@@ -26,120 +45,2621 @@ Database Structure:
 
 DEFAULT_TARGET = 'Things3 export'
 
+ENGINE_BULK = 'bulk'
+ENGINE_QUERY = 'query'
+ENGINE_TREE = 'tree'
 
-def export(args):
+# prepared statements kept per connection; the per-node queries bind their uuid, so a
+# dozen texts are prepared once each and reused for every node
+CACHED_STATEMENTS = 64
+
+# one record per task and checklist item (see RecordExport)
+RECORD_FORMATS = ['jsonl', 'csv']
+# formats exported to a single file (or --stdout), with its extension
+SINGLE_FILE_FORMATS = {'all': '.taskpaper', 'jsonl': '.jsonl', 'csv': '.csv'}
+
+
+def export(args, target=None, progress=None, snapshot=None):
+    """
+    Export the database to the output files described by args.
+
+    target receives all output files (default: FileTarget); pass a
+    MemoryTarget to keep the export in memory. progress (a Progress) counts
+    exported items and can cancel the export. snapshot (a Snapshot) is used
+    instead of opening the database as args.snapshot says, and stays open.
+
+    If args.profile is set (a filename), the export is profiled and the
+    profile report is written to that file, logged and returned.
+    """
+    profile = getattr(args, 'profile', None)
     try:
         args.called_from_gui
     except:
         # log to file only if not called from guo
-        logging.basicConfig(filename='export.log', level=logging.ERROR)
+        logging.basicConfig(filename='export.log', level=logging.INFO if profile else logging.ERROR)
 
-    if args.format not in [RowObject.FMT_ALL, RowObject.FMT_PROJECT, RowObject.FMT_AREA]:
+    if args.format not in [RowObject.FMT_ALL, RowObject.FMT_PROJECT, RowObject.FMT_AREA] + RECORD_FORMATS:
         raise Exception("unknown format %s" % args.format)
 
-    con = sqlite3.connect(args.database)
+    engine = getattr(args, 'engine', ENGINE_BULK)
+    if engine not in [ENGINE_BULK, ENGINE_QUERY, ENGINE_TREE]:
+        raise Exception("unknown engine %s" % engine)
+
+    snapshot_mode = getattr(args, 'snapshot', SNAPSHOT_NONE)
+    if snapshot_mode not in Snapshot.MODES:
+        raise Exception("unknown snapshot mode %s" % snapshot_mode)
+
+    selection = Selection(args)
+    if getattr(args, 'incremental', False) and not (selection.everything and not selection.tasks):
+        # the manifest describes a full export, later runs would keep the files of a partial one
+        raise Exception("an incremental export can't be limited to areas, projects, the inbox, tags or a date")
+
+    archive = getattr(args, 'archive', None)
+    if archive is not None:
+        if archive not in ArchiveTarget.EXTENSIONS:
+            raise Exception("unknown archive format %s" % archive)
+        if args.stdout or getattr(args, 'incremental', False):
+            raise Exception("an archive can't be written to standard output or incrementally")
+
+    if getattr(args, 'perspectives', False) or getattr(args, 'search_index', None) is not None:
+        if args.format in RECORD_FORMATS or getattr(args, 'incremental', False):
+            raise Exception("perspectives and search indexes can't be exported with format %s or incrementally"
+                            % args.format)
+
+    jobs = worker_count(args)
+
+    profiler = Profiler(enabled=bool(profile), trace_memory=getattr(args, 'profile_memory', False))
+    with profiler.phase('total'):
+        own_snapshot = snapshot is None
+        if own_snapshot:
+            with profiler.phase('snapshot'):
+                snapshot = Snapshot(args.database, snapshot_mode, shared=jobs > 1,
+                                    scratch_indexes=getattr(args, 'scratch_indexes', False))
+        try:
+            if target is None:
+                if archive is not None:
+                    target = ArchiveTarget(args.target, archive)
+                elif args.format not in SINGLE_FILE_FORMATS and getattr(args, 'staging', True):
+                    target = StagedTarget(args.target)
+                else:
+                    target = FileTarget()
+            try:
+                # the targets wrapped around it are built here, so a staging folder is removed if they fail
+                if getattr(args, 'incremental', False) and not (args.format in SINGLE_FILE_FORMATS and args.stdout):
+                    target = IncrementalTarget(target, args, snapshot)
+                target = profiler.wrap_target(target)
+                export_database(args, engine, selection, target, progress, profiler, snapshot, jobs)
+            except BaseException:
+                target.abort()
+                raise
+        finally:
+            if own_snapshot:
+                snapshot.close()
+    if profiler.enabled:
+        return profiler.finish(profile)
+
+
+def worker_count(args):
+    """Return the number of processes rendering files (--jobs)."""
+    if args.format in SINGLE_FILE_FORMATS or getattr(args, 'engine', ENGINE_BULK) == ENGINE_TREE:
+        return 1
+    if getattr(args, 'perspectives', False) or getattr(args, 'search_index', None) is not None:
+        return 1  # the indexes are built while the tree is exported in this process
+    return getattr(args, 'jobs', 1) or os.cpu_count()
+
+
+def export_database(args, engine, selection, target, progress, profiler, snapshot, jobs):
+    if jobs > 1:
+        export_parallel(args, selection, target, jobs, snapshot)
+        target.close()
+        return
+
+    with profiler.phase('connect'):
+        con = snapshot.connect(profiler.connect)
 
     con.row_factory = sqlite3.Row
-
-    # reroute stdout
-    if args.format == RowObject.FMT_ALL and not args.stdout:
+    selection.warn_unknown_tags(con)
+    if args.format in RECORD_FORMATS:
+        engine = ENGINE_TREE  # records are always streamed from the tree query
+    source = None
+    if engine != ENGINE_TREE:
+        with profiler.phase('load'):
+            source = make_source(con, engine, selection)
+    if progress is not None:
+        progress.start(con, selection, source)
+        if source is not None:
+            source = ProgressSource(source, progress)
+
+    if args.format not in SINGLE_FILE_FORMATS:
+        # every area or project opens its own file
+        out = NullSink()
+    elif args.stdout:
+        out = StreamSink(sys.stdout)
+    else:
         filename = args.target
-        if not filename.endswith('.taskpaper'):
-            filename = RowObject.FILE_TMPL % filename
-        reroute_stdout(filename)
-    c = con.cursor()
-    no_area = Area(dict(uuid='NULL', title='no area'), con, args)
-    no_area.export()
-    for row in c.execute(Area.QUERY):
-        a = Area(row, con, args)
-        a.export()
+        extension = SINGLE_FILE_FORMATS[args.format]
+        if not filename.endswith(extension):
+            filename += extension
+        if target.unchanged(filename, '', ('all', None)):
+            con.close()
+            target.close()
+            return
+        out = target.open(filename)
+    index = TaskIndexes.from_args(args)
+    try:
+        with out, profiler.phase('export'):
+            if args.format in RECORD_FORMATS:
+                RecordExport(TreeExport(con, args, target, progress, selection)).export(out, args.format)
+            elif engine == ENGINE_TREE:
+                TreeExport(con, args, target, progress, selection, index).export(out)
+            else:
+                export_areas(args, source, target, profiler, out, index)
+    except BaseException:
+        if index is not None:
+            index.abort()
+        raise
+    finally:
+        con.close()
+    if index is not None:
+        index.write(target, args, profiler)
+    with profiler.phase('close'):
+        target.close()
+    if progress is not None:
+        progress.finish()
+
+
+def export_areas(args, source, target, profiler, out, index=None):
+    if source.no_area_selected():
+        no_area = Area(dict(uuid='NULL', title='no area'), source, args, target)
+        with profiler.phase('area: no area'):
+            no_area.export(out, index)
+    for row in source.areas():
+        a = Area(row, source, args, target)
+        with profiler.phase('area: %s' % a.title):
+            a.export(out, index)
+
+
+def make_source(con, engine, selection=None):
+    if engine == ENGINE_BULK:
+        return BulkSource(con, selection)
+    return QuerySource(con, selection)
+
+
+class DatabaseWatcher(object):
+    """
+    Poll the modification time and size of the database and its -wal file.
+
+    wait() returns once they changed and then stayed the same for one
+    interval, so a burst of commits by Things leads to a single export.
+    """
+
+    def __init__(self, database, interval=2.0):
+        self.paths = (database, database + '-wal')
+        self.interval = interval
+        self.last = self.signature()
+
+    def signature(self):
+        signature = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def wait(self):
+        current = self.last
+        while current == self.last:
+            time.sleep(self.interval)
+            current = self.signature()
+        while True:
+            time.sleep(self.interval)
+            settled = self.signature()
+            if settled == current:
+                break
+            current = settled
+        self.last = current
+
+
+WATCH_RETRY_MAX = 60.0
+
+
+def watch(args):
+    """
+    Export, and export again whenever the database changes, until interrupted (--watch).
+
+    The database is copied once (into memory, or into a file with --snapshot
+    file), and before each export only the rows changed since are copied.
+    A failed export or update of the copy (e.g. while Things holds a lock) is
+    logged and tried again after a delay that doubles up to WATCH_RETRY_MAX
+    seconds; only Ctrl-C or SIGTERM stop watching.
+    """
+    mode = args.snapshot if args.snapshot in (SNAPSHOT_MEMORY, SNAPSHOT_FILE) else SNAPSHOT_MEMORY
+    watcher = DatabaseWatcher(args.database, args.watch_interval)
+    snapshot = Snapshot(args.database, mode, shared=worker_count(args) > 1,
+                        scratch_indexes=getattr(args, 'scratch_indexes', False), warm=True)
+    # stop on SIGTERM like on Ctrl-C, so the copy is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    retry = 0  # the delay before trying again after a failure, 0 if the last round succeeded
+    try:
+        while True:
+            try:
+                if retry:
+                    time.sleep(retry)
+                    snapshot.refresh()  # the changes since the failed round
+                start = time.perf_counter()
+                export(args, snapshot=snapshot)
+                retry = 0
+                print("%s exported in %.2fs, watching %s" % (
+                    datetime.now().strftime("%H:%M:%S"), time.perf_counter() - start, args.database),
+                    file=sys.stderr)
+                changes = 0
+                while not changes:
+                    watcher.wait()
+                    changes = snapshot.refresh()
+                print("%s %d rows changed" % (datetime.now().strftime("%H:%M:%S"), changes), file=sys.stderr)
+            except Exception as e:
+                retry = min(retry * 2 or args.watch_interval, WATCH_RETRY_MAX)
+                logging.exception("watch: export failed")
+                print("%s export failed (%s), trying again in %gs" % (
+                    datetime.now().strftime("%H:%M:%S"), e, retry), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        snapshot.close()
+
+
+def batch_databases(patterns):
+    """Return the databases in the folders (searched recursively) or matching the glob patterns, sorted."""
+    databases = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for folder, _, filenames in os.walk(pattern):
+                databases.update(os.path.join(folder, filename) for filename in filenames
+                                 if filename == 'main.sqlite' or filename.endswith('.sqlite3'))
+        else:
+            databases.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(databases)
+
+
+def batch_targets(databases, target):
+    """
+    Return the target of each database: below target, named after its path
+    relative to the folder that contains all of them, without main.sqlite
+    or the extension of a legacy database.
+    """
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(database)) for database in databases])
+    targets = []
+    for database in databases:
+        folder, filename = os.path.split(os.path.relpath(os.path.abspath(database), base))
+        if filename == 'main.sqlite':
+            name = folder or os.path.basename(base)
+        else:
+            name = os.path.join(folder, os.path.splitext(filename)[0])
+        targets.append(os.path.join(target, name))
+    return targets
+
+
+def batch_export(args):
+    """
+    Export every database given with --batch into its own target below args.target (--batch).
+
+    Up to args.jobs databases (0: one per CPU) are exported at the same
+    time, each in a worker process. A database that fails is reported and
+    skipped. Returns the number of failed databases.
+    """
+    databases = batch_databases(args.batch)
+    if not databases:
+        print("no databases found", file=sys.stderr)
+        return 0
+    units = []
+    for database, target in zip(databases, batch_targets(databases, args.target)):
+        unit_args = argparse.Namespace(**vars(args))
+        unit_args.database, unit_args.target, unit_args.batch, unit_args.jobs = database, target, [], 1
+        units.append(unit_args)
+
+    jobs = min(args.jobs or os.cpu_count(), len(units))
+    start = time.perf_counter()
+    failed = tasks = 0
+    with contextlib.ExitStack() as stack:
+        if jobs > 1:
+            results = stack.enter_context(multiprocessing.Pool(jobs)).imap_unordered(export_batch_unit, units)
+        else:
+            results = map(export_batch_unit, units)
+        for database, target, unit_tasks, seconds, error in results:
+            if error is None:
+                tasks += unit_tasks
+                print("%s -> %s: %d tasks in %.2fs" % (database, target, unit_tasks, seconds))
+            else:
+                failed += 1
+                print("%s failed: %s" % (database, error), file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    print("%d databases (%d failed), %d tasks in %.2fs with %d workers: %.1f databases/s, %.0f tasks/s" % (
+        len(units), failed, tasks, elapsed, jobs, (len(units) - failed) / elapsed, tasks / elapsed))
+    return failed
+
+
+def export_batch_unit(args):
+    """Export one database of a batch, return (database, target, tasks, seconds, error message or None)."""
+    progress = Progress()
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(args.target), exist_ok=True)
+        export(args, progress=progress)
+    except Exception as e:
+        logging.exception("exporting %s failed", args.database)
+        return args.database, args.target, 0, time.perf_counter() - start, "%s: %s" % (type(e).__name__, e)
+    return args.database, args.target, progress.done['tasks'], time.perf_counter() - start, None
+
+
+SNAPSHOT_NONE = 'none'
+SNAPSHOT_READONLY = 'readonly'
+SNAPSHOT_IMMUTABLE = 'immutable'
+SNAPSHOT_MEMORY = 'memory'
+SNAPSHOT_FILE = 'file'
+
+
+def database_uri(database, **params):
+    return 'file:%s?%s' % (pathname2url(os.path.abspath(database)), urlencode(params))
+
+
+def read_only_uri(database, mode=SNAPSHOT_READONLY):
+    if mode == SNAPSHOT_IMMUTABLE or closed_wal_database(database):
+        return database_uri(database, immutable=1)
+    return database_uri(database, mode='ro')
+
+
+def closed_wal_database(database):
+    """
+    Return True if database is in WAL mode but has no -wal file, i.e. no one has it open.
+
+    A read-only connection to such a database creates -wal and -shm files that
+    it can't remove when it's closed (Things keeps them while it runs, backups
+    have none), so it is read as immutable instead.
+    """
+    if os.path.exists(database + '-wal'):
+        return False
+    try:
+        with open(database, 'rb') as f:
+            header = f.read(20)
+    except OSError:
+        return False
+    return len(header) == 20 and header[18] == header[19] == 2  # file format versions 2: WAL
+
+
+class Snapshot(object):
+    """
+    Open the database of an export so that it neither blocks nor is blocked by
+    a running Things app.
+
+    Modes:
+    - none: open the database as it is (the default)
+    - readonly: open the database read-only
+    - immutable: open the database as immutable, SQLite takes no locks at all
+      (changes still in the -wal file are not seen, so only use this if Things
+      is closed or the database was copied)
+    - memory: copy the database into memory with the online backup API
+    - file: copy the database into a temporary file with the online backup API
+
+    All connections are set up for reading (mmap, large cache, query only).
+
+    The copies (memory and file) are private, so with scratch_indexes the
+    indexes in SCRATCH_INDEXES are added to them, which let the per-node
+    queries search and sort without scanning TMTask (see explain_query_plans).
+
+    A warm copy is kept for several exports (see --watch): refresh() updates
+    it with the rows modified since, and a warm memory copy is copied again
+    (in memory) for every connection.
+    """
+
+    MODES = (SNAPSHOT_NONE, SNAPSHOT_READONLY, SNAPSHOT_IMMUTABLE, SNAPSHOT_MEMORY, SNAPSHOT_FILE)
+
+    READ_PRAGMAS = """
+        PRAGMA mmap_size = 268435456;
+        PRAGMA cache_size = -65536;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA query_only = ON;
+    """
+
+    # partial indexes with the filter shared by all task queries, in the order the queries sort
+    SCRATCH_INDEXES = """
+        CREATE INDEX scratch_task_project ON TMTask (project, type, "index")
+            WHERE trashed = 0 AND status < 2;
+        CREATE INDEX scratch_task_area ON TMTask (area, project, type, "index")
+            WHERE trashed = 0 AND status < 2;
+        CREATE INDEX scratch_project_area ON TMTask (area, type, "index")
+            WHERE trashed = 0 AND status < 2;
+        CREATE INDEX scratch_task_action_group ON TMTask (actionGroup, type, "index")
+            WHERE trashed = 0 AND status < 2;
+        CREATE INDEX scratch_inbox ON TMTask ("index")
+            WHERE type != 1 AND project IS NULL AND area IS NULL AND actionGroup IS NULL
+            AND trashed = 0 AND status < 2;
+        CREATE INDEX scratch_checklist_task ON TMChecklistItem (task, "index");
+        CREATE INDEX scratch_task_tags ON TMTaskTag (tasks);
+        CREATE INDEX scratch_area_tags ON TMAreaTag (areas);
+        ANALYZE;
+    """
+
+    # tables with a modification date, refresh() only copies rows whose modification date changed
+    MODIFIED_TABLES = ('TMTask', 'TMChecklistItem')
+    # small tables without modification date, refresh() copies them completely
+    COPIED_TABLES = ('TMArea', 'TMTag', 'TMTaskTag', 'TMAreaTag')
+
+    def __init__(self, database, mode=SNAPSHOT_NONE, shared=False, scratch_indexes=False, warm=False):
+        """With shared, the snapshot must be readable from other processes (memory becomes file)."""
+        self.database = database
+        self.mode = mode
+        self.scratch_indexes = scratch_indexes
+        self.copy = None
+        self.warm = None
+        if mode == SNAPSHOT_MEMORY and shared:
+            self.mode = SNAPSHOT_FILE
+        if (scratch_indexes or warm) and self.mode not in (SNAPSHOT_MEMORY, SNAPSHOT_FILE):
+            raise Exception("scratch indexes and warm snapshots need a copy of the database (snapshot memory or file)")
+        if self.mode == SNAPSHOT_FILE:
+            fd, self.copy = tempfile.mkstemp(prefix='things-snapshot-', suffix='.sqlite')
+            os.close(fd)
+            con = sqlite3.connect(self.copy)
+            self.backup(con)
+            # the copy inherits WAL mode, which would leave -wal and -shm files behind
+            con.execute("PRAGMA journal_mode = DELETE;")
+            con.close()
+        elif self.mode == SNAPSHOT_MEMORY and warm:
+            self.warm = sqlite3.connect('file::memory:', uri=True)
+            self.backup(self.warm)
+
+    def backup(self, con):
+        source = sqlite3.connect(read_only_uri(self.database), uri=True)
+        source.backup(con)
+        source.close()
+        if self.scratch_indexes:
+            con.executescript(self.SCRATCH_INDEXES)
+
+    def refresh(self):
+        """
+        Update the copy with the changes in the database, return the number of changed rows.
+
+        Rows whose userModificationDate changed are copied again (compared per
+        row, so changes synced late with an older date are not missed),
+        deleted rows are removed, and the small tables without modification
+        date are copied completely if they differ.
+        """
+        if self.warm is not None:
+            con = self.warm
+        else:
+            con = sqlite3.connect(database_uri(self.copy), uri=True)
+        changes = con.total_changes
+        con.execute('ATTACH DATABASE ? AS live;', (read_only_uri(self.database),))
+        try:
+            with con:
+                for table in self.MODIFIED_TABLES:
+                    con.execute('DELETE FROM main.{0} WHERE uuid NOT IN (SELECT uuid FROM live.{0});'.format(table))
+                    con.execute('INSERT OR REPLACE INTO main.{0} SELECT new.* FROM live.{0} AS new '
+                                'LEFT JOIN main.{0} AS old ON old.uuid = new.uuid '
+                                'WHERE old.userModificationDate IS NOT new.userModificationDate;'.format(table))
+                for table in self.COPIED_TABLES:
+                    differs = con.execute('SELECT EXISTS (SELECT * FROM live.{0} EXCEPT SELECT * FROM main.{0}) '
+                                          'OR EXISTS (SELECT * FROM main.{0} EXCEPT SELECT * FROM live.{0});'
+                                          .format(table)).fetchone()[0]
+                    if differs:
+                        con.execute('DELETE FROM main.{0};'.format(table))
+                        con.execute('INSERT INTO main.{0} SELECT * FROM live.{0} ORDER BY rowid;'.format(table))
+                changes = con.total_changes - changes
+        finally:
+            con.execute('DETACH DATABASE live;')
+        if con is not self.warm:
+            con.close()
+        return changes
+
+    def connect(self, connect=sqlite3.connect):
+        """Return a connection to the snapshot, connect is called like sqlite3.connect."""
+        if self.mode == SNAPSHOT_NONE:
+            con = connect(self.database, cached_statements=CACHED_STATEMENTS)
+        elif self.warm is not None:
+            con = connect(':memory:', cached_statements=CACHED_STATEMENTS)
+            self.warm.backup(con)
+        elif self.mode == SNAPSHOT_MEMORY:
+            con = connect(':memory:', cached_statements=CACHED_STATEMENTS)
+            self.backup(con)
+        else:
+            con = connect(read_only_uri(*self.view()), uri=True, cached_statements=CACHED_STATEMENTS)
+        con.executescript(self.READ_PRAGMAS)
+        return con
+
+    def view(self):
+        """Return (database, mode) for opening the snapshot read-only with connect_read_only (e.g. in another process)."""
+        if self.copy:
+            return self.copy, SNAPSHOT_READONLY
+        if self.mode == SNAPSHOT_IMMUTABLE:
+            return self.database, SNAPSHOT_IMMUTABLE
+        return self.database, SNAPSHOT_READONLY
+
+    def close(self):
+        if self.copy:
+            os.remove(self.copy)
+            self.copy = None
+        if self.warm is not None:
+            self.warm.close()
+            self.warm = None
+
+
+def explain_query_plans(con, selection=None):
+    """
+    Return the query plan of every per-node query: [(name, [plan detail, ...], full_scan)].
+
+    full_scan is True if the plan scans a whole table instead of searching an index.
+    """
+    s = selection or Selection()
+    uuid = ('Xuuid0000000000000000',)
+    queries = [
+        ('Area.TAGS_QUERY', Area.TAGS_QUERY, uuid),
+        ('RowObjectWithTags.TAGS_QUERY', RowObjectWithTags.TAGS_QUERY, uuid),
+        ('Project.PROJECTS_IN_AREA', Project.PROJECTS_IN_AREA % s.projects, uuid),
+        ('Project.PROJECTS_WITHOUT_AREA', Project.PROJECTS_WITHOUT_AREA % s.projects, ()),
+        ('Task.TASKS_IN_PROJECT', Task.TASKS_IN_PROJECT % s.tasks, uuid),
+        ('Task.TASKS_IN_AREA_WITHOUT_PROJECT', Task.TASKS_IN_AREA_WITHOUT_PROJECT % s.area_tasks, uuid),
+        ('Task.TASKS_IN_INBOX', Task.TASKS_IN_INBOX % s.tasks, ()),
+        ('Task.TASKS_IN_ACTION_GROUPS', Task.TASKS_IN_ACTION_GROUPS % s.tasks, uuid),
+        ('CheckListItem.items_of_task', CheckListItem.items_of_task, uuid),
+    ]
+    plans = []
+    for name, query, parameters in queries:
+        details = [row[-1] for row in con.execute('EXPLAIN QUERY PLAN ' + query.split(';')[0], parameters)]
+        full_scan = any(detail.startswith('SCAN ') and ' USING ' not in detail for detail in details)
+        plans.append((name, details, full_scan))
+    return plans
+
+
+def connect_read_only(database, mode=SNAPSHOT_READONLY):
+    con = sqlite3.connect(read_only_uri(database, mode), uri=True, cached_statements=CACHED_STATEMENTS)
+    con.executescript(Snapshot.READ_PRAGMAS)
+    con.row_factory = sqlite3.Row
+    return con
+
+
+def export_parallel(args, selection, target, jobs, snapshot):
+    """
+    Render the files of format area or project in a pool of worker processes.
+
+    The main process enumerates the areas (and projects) and creates the
+    folders, every worker renders whole files. With the bulk engine the main
+    process loads the database once and sends each unit its rows (UnitSource),
+    the other engines query per node from a read-only connection in each
+    worker. Files are written in the same order as in a serial export.
+    """
+    view = snapshot.view()
+    engine = getattr(args, 'engine', ENGINE_BULK)
+    con = connect_read_only(*view)
+    selection.warn_unknown_tags(con)
+    source = make_source(con, engine, selection)
+    areas = [dict(row) for row in source.areas()]
+    if source.no_area_selected():
+        areas.insert(0, dict(uuid='NULL', title='no area'))
+    units = []
+    if args.format == RowObject.FMT_AREA:
+        target.makedirs(args.target)
+        for row in areas:
+            if not target.unchanged(RowObject.FILE_TMPL % row['title'], args.target, ('area', row['uuid'])):
+                units.append((row, None, None))
+    else:
+        for row in areas:
+            area = Area(row, source, args, target)
+            area.path = os.path.join(args.target, area.title)
+            target.makedirs(area.path)
+            for p in area.projects(0):
+                if not target.unchanged(p.FILE_TMPL % p.title, area.path, ('project', p.uuid)):
+                    units.append((row, p.as_row(), p.level))
     con.close()
 
-    if args.format == RowObject.FMT_ALL and not args.stdout:
-        sys.stdout = sys.__stdout__
+    if engine == ENGINE_BULK:
+        units = ((area_row, project_row, level,
+                  UnitSource(source, area_row['uuid'], project_row and project_row['uuid']))
+                 for area_row, project_row, level in units)
+    else:
+        units = (unit + (None,) for unit in units)
+    with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(args, engine, view)) as pool:
+        for files in pool.imap(render_unit, units):
+            for filename, text in files:
+                with target.open(filename) as out:
+                    out.write(text)
 
 
-def reroute_stdout(filename, path_prefix=''):
-    print("rerouting standardout to", filename)
+_worker = {}
+
+
+def init_worker(args, engine, view):
+    _worker.update(args=args)
+    if engine != ENGINE_BULK:
+        con = connect_read_only(*view)
+        _worker.update(source=QuerySource(con, Selection(args)))
+
+
+def render_unit(unit):
+    """Render one area (format area) or project (format project) in a worker, return [(filename, text)]."""
+    area_row, project_row, level, source = unit
+    args = _worker['args']
+    target = MemoryTarget()
+    area = Area(area_row, source or _worker['source'], args, target)
+    if project_row is None:
+        area.export(NullSink())
+    else:
+        area.path = os.path.join(args.target, area.title)
+        Project(project_row, area.source, args, level, area).export(NullSink())
+    return [(filename, sink.getvalue()) for filename, sink in target.files.items()]
+
+
+def make_tag(title):
+    return '@' + title.replace(' ', '_').replace('-', '_')
+
+
+def format_date(timestamp):
+    if timestamp:
+        return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+
+def output_path(filename, path_prefix=''):
     if path_prefix:
         filename = filename.replace(r'/', '|')
         filename = os.path.join(path_prefix, filename)
-    sys.stdout = open(filename, 'w')
+    return filename
 
 
-class RowObject(object):
-    PROJECT_TEMPLATE = "\n%(indent)s%(title)s:%(tags)s"
-    FMT_ALL = 'all'
-    FMT_PROJECT = 'project'
-    FMT_AREA = 'area'
+class Sink(object):
+    """Receives the lines of one output file."""
+
+    def write(self, text):
+        raise NotImplementedError
+
+    def writeline(self, line):
+        self.write(line + '\n')
 
-    def __init__(self, row, con, args, level=0):
-        self.row = row
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FileSink(Sink):
+    """
+    Write to a file through a large buffer.
+
+    The output goes to a partial file that replaces the file when the sink is
+    closed, or is removed if the export fails or is cancelled.
+    """
+
+    BUFFER_SIZE = 1024 * 1024
+    PARTIAL_TMPL = "%s.part"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.partial = self.PARTIAL_TMPL % filename
+        self.file = open(self.partial, 'w', buffering=self.BUFFER_SIZE)
+        self.write = self.file.write
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.partial)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.partial, self.filename)
+
+
+class StringSink(Sink):
+    """Collect the output in memory."""
+
+    def __init__(self):
+        self.chunks = []
+        self.write = self.chunks.append
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class StreamSink(Sink):
+    """Write to an already open stream (e.g. sys.stdout), which is flushed but not closed."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.write = stream.write
+
+    def close(self):
+        self.stream.flush()
+
+
+class NullSink(Sink):
+    """Discard everything (output that does not belong to any file)."""
+
+    def write(self, text):
+        pass
+
+
+class Target(object):
+    """Receives the output files of an export."""
+
+    def open(self, filename, path_prefix=''):
+        """Return a sink for the output file."""
+        raise NotImplementedError
+
+    def makedirs(self, path):
+        pass
+
+    def unchanged(self, filename, path_prefix, subtree):
+        """Return True if the output file for subtree does not need to be exported again."""
+        return False
+
+    def remove(self, filename):
+        """Remove an output file of an earlier export."""
+        pass
+
+    def close(self):
+        """Called after a successful export."""
+        pass
+
+    def abort(self):
+        """Called instead of close() when the export failed or was cancelled."""
+        pass
+
+
+class FileTarget(Target):
+    """Write every output file to disk."""
+
+    def open(self, filename, path_prefix=''):
+        filename = output_path(filename, path_prefix)
+        logging.info("writing %s", filename)
+        return FileSink(filename)
+
+    def makedirs(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def remove(self, filename):
+        logging.info("removing %s", filename)
+        os.remove(filename)
+        try:
+            os.rmdir(os.path.dirname(filename))
+        except OSError:
+            pass  # folder is not empty
+
+
+class StagedSink(FileSink):
+    """Write straight to a file in the staging folder, nobody reads it before the swap."""
+
+    PARTIAL_TMPL = "%s"
+
+    def close(self):
+        self.file.close()
+
+
+class StagedTarget(FileTarget):
+    """
+    Export the files below root to a staging folder next to it, then swap it in.
+
+    Staged files are written without partial files or fsyncs. When the export
+    is complete, the files of the old folder that are unchanged or not
+    exported again are hard linked into the staging folder, so they keep
+    their inode and modification time, and the staging folder replaces root
+    with two renames. A failed export removes the staging folder and leaves
+    root alone. Files outside of root are written as by FileTarget.
+    """
+
+    STAGING_TMPL = ".%s.%s.staging"
+    OLD_TMPL = "%s.old"
+
+    def __init__(self, root):
+        # a target that links into another folder (e.g. a synced one) is swapped in that folder
+        self.root = os.path.realpath(root)
+        self.staging = os.path.join(os.path.dirname(self.root),
+                                    self.STAGING_TMPL % (os.path.basename(self.root), os.urandom(4).hex()))
+        os.makedirs(os.path.dirname(self.root), exist_ok=True)  # like makedirs(root) without staging
+        os.mkdir(self.staging)
+        if os.path.isdir(self.root):
+            shutil.copymode(self.root, self.staging)
+        self.removed = set()
+
+    def staged(self, path):
+        """Return the path of path in the staging folder, None if it is not below root."""
+        relative = os.path.relpath(os.path.realpath(path), self.root)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        return os.path.normpath(os.path.join(self.staging, relative))
+
+    def open(self, filename, path_prefix=''):
+        filename = output_path(filename, path_prefix)
+        staged = self.staged(filename)
+        if staged is None:
+            return super().open(filename)
+        logging.info("writing %s", filename)
+        return StagedSink(staged)
+
+    def makedirs(self, path):
+        staged = self.staged(path)
+        if staged is None:
+            super().makedirs(path)
+        else:
+            os.makedirs(staged, exist_ok=True)
+
+    def remove(self, filename):
+        if self.staged(filename) is None:
+            super().remove(filename)
+        else:
+            logging.info("removing %s", filename)
+            self.removed.add(os.path.realpath(filename))
+
+    def close(self):
+        if not os.path.isdir(self.root):
+            os.rename(self.staging, self.root)
+            return
+        self.keep_old_files()
+        old = self.OLD_TMPL % self.staging
+        os.rename(self.root, old)
+        os.rename(self.staging, self.root)
+        if os.path.islink(old):
+            os.remove(old)
+        else:
+            shutil.rmtree(old)
+
+    def keep_old_files(self):
+        """
+        Link the files of root into the staging folder unless they were exported with a different content.
+
+        Folders (also empty ones) and symlinks that were not exported are
+        recreated as they are; a folder that only held removed files is removed.
+        Every folder that was in root gets its old mode and times back at the end.
+        """
+        folders = []  # (old, staged) folders, parents first
+        for folder, dirs, filenames in os.walk(self.root):
+            staged_folder = os.path.join(self.staging, os.path.relpath(folder, self.root))
+            for name in dirs:
+                old = os.path.join(folder, name)
+                staged = os.path.join(staged_folder, name)
+                if os.path.islink(old):
+                    if not os.path.lexists(staged):
+                        os.symlink(os.readlink(old), staged)
+                else:
+                    os.makedirs(staged, exist_ok=True)
+                    folders.append((old, staged))
+            for name in filenames:
+                old = os.path.join(folder, name)
+                if old in self.removed:
+                    continue
+                staged = os.path.join(staged_folder, name)
+                if os.path.islink(old):
+                    if not os.path.lexists(staged):
+                        os.symlink(os.readlink(old), staged)
+                    continue
+                if os.path.exists(staged):
+                    if not filecmp.cmp(old, staged, shallow=False):
+                        continue
+                    os.remove(staged)
+                os.makedirs(staged_folder, exist_ok=True)
+                try:
+                    os.link(old, staged)
+                except OSError:
+                    shutil.copy2(old, staged)  # no hard links on this file system
+        for removed in self.removed:
+            staged_folder = self.staged(os.path.dirname(removed))
+            if staged_folder != os.path.normpath(self.staging) and os.path.isdir(staged_folder) \
+                    and not os.listdir(staged_folder):
+                os.rmdir(staged_folder)
+        # children first, and after their contents, so a read-only folder can still be filled
+        for old, staged in reversed(folders):
+            if os.path.isdir(staged):
+                shutil.copystat(old, staged)
+
+    def abort(self):
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+
+class MemoryTarget(Target):
+    """Keep every output file in memory as a StringSink, indexed by path."""
+
+    def __init__(self):
+        self.files = {}
+
+    def open(self, filename, path_prefix=''):
+        sink = StringSink()
+        self.files[output_path(filename, path_prefix)] = sink
+        return sink
+
+    def makedirs(self, path):
+        pass
+
+
+class IncrementalSink(StringSink):
+    """Collect the output of one file and hand it to its target (IncrementalTarget, ArchiveTarget) when done."""
+
+    def __init__(self, target, filename):
+        super().__init__()
+        self.target = target
+        self.filename = filename
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+
+    def close(self):
+        self.target.store(self.filename, self.getvalue())
+
+
+class ArchiveTarget(Target):
+    """
+    Write every output file as a member of one zip or tar.gz archive (--archive).
+
+    Members are named like the files of a FileTarget, relative to the folder
+    that contains the target, so unpacking the archive there gives the same
+    layout. The archive is written sequentially through a single file handle
+    to a partial file, which replaces the archive when the export is done.
+    """
+
+    EXTENSIONS = {'zip': '.zip', 'tar.gz': '.tar.gz'}
+
+    def __init__(self, target, archive_format):
+        self.root = os.path.dirname(os.path.abspath(target))
+        self.filename = target.rstrip(os.sep) + self.EXTENSIONS[archive_format]
+        self.partial = FileSink.PARTIAL_TMPL % self.filename
+        if archive_format == 'zip':
+            self.archive = zipfile.ZipFile(self.partial, 'w', zipfile.ZIP_DEFLATED)
+            self.add = self.add_to_zip
+        else:
+            self.archive = tarfile.open(self.partial, 'w:gz')
+            self.add = self.add_to_tar
+        self.folders = set()
+
+    def member(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, '/')
+
+    def open(self, filename, path_prefix=''):
+        filename = output_path(filename, path_prefix)
+        logging.info("writing %s to %s", filename, self.filename)
+        return IncrementalSink(self, self.member(filename))
+
+    def makedirs(self, path):
+        """Add the folder and its parents, so empty folders are kept."""
+        name = self.member(path)
+        parents = name.split('/')
+        for i in range(1, len(parents) + 1):
+            folder = '/'.join(parents[:i])
+            if folder not in self.folders:
+                self.folders.add(folder)
+                self.add(folder + '/', None)
+
+    def store(self, name, text):
+        self.add(name, text.encode('utf-8'))
+
+    def add_to_zip(self, name, data):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        if data is None:
+            info.external_attr = (0o40755 << 16) | 0x10  # folder, MS-DOS directory flag
+            data = b''
+        else:
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+        self.archive.writestr(info, data)
+
+    def add_to_tar(self, name, data):
+        info = tarfile.TarInfo(name.rstrip('/'))
+        info.mtime = time.time()
+        if data is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            self.archive.addfile(info)
+        else:
+            info.mode = 0o644
+            info.size = len(data)
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+        os.replace(self.partial, self.filename)
+
+    def abort(self):
+        self.archive.close()
+        os.remove(self.partial)
+
+
+class IncrementalTarget(Target):
+    """
+    Only export files whose subtree changed since the last run.
+
+    A manifest next to the target folder records, for each output file, the
+    fingerprint of its subtree (see SubtreeFingerprints) and a hash of its
+    content. Files with an unchanged subtree are skipped, files with unchanged
+    content are not rewritten, and files that are no longer exported are
+    deleted. All writes go through the wrapped target.
+    """
+
+    MANIFEST_TMPL = "%s.manifest.json"
+    VERSION = 1
+
+    def __init__(self, target, args, snapshot):
+        self.target = target
+        self.manifest_path = self.MANIFEST_TMPL % args.target.rstrip(os.sep)
+        self.format = args.format
+        self.old_files = {}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError) as e:
+                # e.g. truncated by a killed run or a sync conflict: export everything again
+                logging.error("can't read %s, exporting all files: %s", self.manifest_path, e)
+                manifest = {}
+            if isinstance(manifest, dict) and manifest.get('version') == self.VERSION \
+                    and manifest.get('format') == self.format:
+                self.old_files = manifest['files']
+        self.files = {}
+        self.fingerprints = {}
+        con = connect_read_only(*snapshot.view())
+        self.subtrees = SubtreeFingerprints(con)
+        con.close()
+
+    def unchanged(self, filename, path_prefix, subtree):
+        filename = output_path(filename, path_prefix)
+        fingerprint = self.subtrees.fingerprint(*subtree)
+        self.fingerprints[filename] = fingerprint
+        old = self.old_files.get(filename)
+        if old is None or not os.path.exists(filename):
+            return False
+        if any(old.get(key) != value for key, value in fingerprint.items()):
+            return False
+        logging.info("unchanged %s", filename)
+        self.files[filename] = old
+        return True
+
+    def open(self, filename, path_prefix=''):
+        return IncrementalSink(self, output_path(filename, path_prefix))
+
+    def store(self, filename, text):
+        sha1 = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        old = self.old_files.get(filename)
+        if old is None or old['sha1'] != sha1 or not os.path.exists(filename):
+            with self.target.open(filename) as out:
+                out.write(text)
+        entry = dict(self.fingerprints.pop(filename, {}))
+        entry['sha1'] = sha1
+        self.files[filename] = entry
+
+    def makedirs(self, path):
+        self.target.makedirs(path)
+
+    def close(self):
+        for filename in self.old_files:
+            if filename not in self.files and os.path.exists(filename):
+                self.target.remove(filename)
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(version=self.VERSION, format=self.format, files=self.files), f, indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+        self.target.close()
+
+    def abort(self):
+        self.target.abort()
+
+
+class SubtreeFingerprints(object):
+    """
+    Summarise the subtree behind each output file by its latest
+    userModificationDate and digests of its task rows, tags and checklist
+    items, computed from one scan of each table.
+
+    Subtrees are ('project', uuid) (the inbox is 'NULL'), ('area', uuid)
+    and ('all', None).
+    """
+
+    TASKS_QUERY = """
+        SELECT uuid, type, area, project, actionGroup, userModificationDate, "index", status, trashed
+        FROM TMTask;
+    """
+    CHECKLIST_QUERY = """
+        SELECT uuid, task, userModificationDate, "index", status FROM TMChecklistItem;
+    """
+    TASK_TAGS_QUERY = """
+        SELECT tt.tasks AS uuid, tag.title AS title FROM TMTaskTag AS tt, TMTag AS tag
+        WHERE tt.tags = tag.uuid;
+    """
+    AREA_TAGS_QUERY = """
+        SELECT at.areas AS uuid, tag.title AS title FROM TMAreaTag AS at, TMTag AS tag
+        WHERE at.tags = tag.uuid;
+    """
+    KINDS = ('tasks', 'tags', 'checklists')
+
+    def __init__(self, con):
+        c = con.cursor()
+        self.parts = {}
+        self.areas = ['NULL'] + [row['uuid'] for row in c.execute(Area.QUERY % '')]
+        self.projects_of_area = {'NULL': ['NULL']}
+
+        rows = c.execute(self.TASKS_QUERY).fetchall()
+        keys_of_heading = {row['uuid']: self.keys_of(row) for row in rows if row['type'] == Task.ACTIONGROUP}
+        keys_of_task = {}
+        for row in rows:
+            keys = self.keys_of(row)
+            if row['actionGroup'] is not None:
+                keys |= keys_of_heading.get(row['actionGroup'], set())
+            keys_of_task[row['uuid']] = keys
+            for key in keys:
+                self.add(key, 'tasks', tuple(row), row['userModificationDate'])
+            if row['type'] == Task.PROJECT:
+                self.projects_of_area.setdefault(row['area'] or 'NULL', []).append(row['uuid'])
+
+        for row in c.execute(self.CHECKLIST_QUERY):
+            for key in keys_of_task.get(row['task'], ()):
+                self.add(key, 'checklists', tuple(row), row['userModificationDate'])
+        for row in c.execute(self.TASK_TAGS_QUERY):
+            for key in keys_of_task.get(row['uuid'], ()):
+                self.add(key, 'tags', tuple(row))
+        for row in c.execute(self.AREA_TAGS_QUERY):
+            self.add(('area', row['uuid']), 'tags', tuple(row))
+        for row in c.execute('SELECT uuid, title, "index" FROM TMArea;'):
+            self.add(('area', row['uuid']), 'tasks', tuple(row))
+
+    @staticmethod
+    def keys_of(row):
+        """Return the subtrees a task row is exported in (same filters as the queries in Task and Project)."""
+        if row['type'] == Task.PROJECT:
+            return {('project', row['uuid'])}
+        if row['project'] is not None:
+            return {('project', row['project'])}
+        if row['area'] is not None:
+            return {('area', row['area'])}
+        if row['actionGroup'] is None:
+            return {('project', 'NULL')}
+        return set()
+
+    def add(self, key, kind, item, modified=None):
+        part = self.parts.setdefault(key, dict(modified=None, tasks=[], tags=[], checklists=[]))
+        part[kind].append(repr(item))
+        if modified is not None and (part['modified'] is None or modified > part['modified']):
+            part['modified'] = modified
+
+    def digest(self, key):
+        part = self.parts.get(key, dict(modified=None, tasks=[], tags=[], checklists=[]))
+        fingerprint = dict(modified=part['modified'])
+        for kind in self.KINDS:
+            fingerprint[kind] = hashlib.sha1('\n'.join(sorted(part[kind])).encode('utf-8')).hexdigest()
+        return fingerprint
+
+    def combine(self, fingerprints):
+        combined = dict(modified=None)
+        for kind in self.KINDS:
+            combined[kind] = hashlib.sha1(''.join(f[kind] for f in fingerprints).encode('utf-8')).hexdigest()
+        dates = [f['modified'] for f in fingerprints if f['modified'] is not None]
+        if dates:
+            combined['modified'] = max(dates)
+        return combined
+
+    def fingerprint(self, kind, uuid):
+        if kind == 'project':
+            return self.digest(('project', uuid))
+        if kind == 'area':
+            projects = sorted(self.projects_of_area.get(uuid, []))
+            return self.combine([self.digest(('area', uuid))] +
+                                [self.digest(('project', project)) for project in projects])
+        return self.combine([self.fingerprint('area', area) for area in self.areas])
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Cursor that adds the time spent in SQLite to the profiler of its connection."""
+
+    def timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.connection.profiler.add_time(self.template, time.perf_counter() - start)
+
+    def execute(self, sql, parameters=()):
+        self.template = self.connection.profiler.template(sql)
+        return self.timed(super().execute, sql, parameters)
+
+    def __next__(self):
+        return self.timed(super().__next__)
+
+    def fetchone(self):
+        return self.timed(super().fetchone)
+
+    def fetchall(self):
+        return self.timed(super().fetchall)
+
+
+class ProfilingConnection(sqlite3.Connection):
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+
+class TimedSink(Sink):
+    """Wrap a sink to measure the time spent writing."""
+
+    def __init__(self, sink, profiler):
+        self.sink = sink
+        self.profiler = profiler
+
+    def write(self, text):
+        start = time.perf_counter()
+        self.sink.write(text)
+        self.profiler.add_write(time.perf_counter() - start)
+
+    def close(self):
+        self.__exit__(None, None, None)
+
+    def __exit__(self, *exc_info):
+        start = time.perf_counter()
+        self.sink.__exit__(*exc_info)
+        self.profiler.add_write(time.perf_counter() - start)
+
+
+class ProfilingTarget(Target):
+    """Wrap a target so that the profiler sees the time spent writing files."""
+
+    def __init__(self, target, profiler):
+        self.target = target
+        self.profiler = profiler
+
+    def open(self, filename, path_prefix=''):
+        return TimedSink(self.target.open(filename, path_prefix), self.profiler)
+
+    def makedirs(self, path):
+        self.target.makedirs(path)
+
+    def unchanged(self, filename, path_prefix, subtree):
+        return self.target.unchanged(filename, path_prefix, subtree)
+
+    def remove(self, filename):
+        self.target.remove(filename)
+
+    def close(self):
+        self.target.close()
+
+    def abort(self):
+        self.target.abort()
+
+
+class Profiler(object):
+    """
+    Collect statistics of one export (see --profile).
+
+    Every SQL statement is counted (with a trace callback) and timed (with
+    ProfilingCursor) under the name of the query template it was made from,
+    e.g. Task.TASKS_IN_PROJECT. Phases (connect, load, export, every area,
+    close) are timed, as is writing the output. With trace_memory, the peak
+    memory of each phase is measured with tracemalloc.
+
+    A disabled profiler does nothing, so the exporter can use it unconditionally.
+    """
+
+    QUERY_CLASSES = ('Area', 'RowObjectWithTags', 'Project', 'Task', 'CheckListItem', 'BulkSource', 'TagIndex',
+                     'TreeExport', 'Selection')
+
+    def __init__(self, enabled=True, trace_memory=False):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.phases = {}
+        self.statements = {}
+        self.sql_seconds = 0.0
+        self.write_seconds = 0.0
+        self.writes = 0
+        self.depth = 0
+        self.templates = []
+        if not enabled:
+            return
+        for class_name in self.QUERY_CLASSES:
+            for name, value in vars(globals()[class_name]).items():
+                if isinstance(value, str) and 'SELECT' in value:
+                    self.add_template('%s.%s' % (class_name, name), value)
+        for name, value in Progress.COUNT_QUERIES.items():
+            self.add_template('Progress.COUNT_QUERIES[%s]' % name, value)
+        self.template = functools.lru_cache(maxsize=1024)(self.template)
+        if self.trace_memory:
+            tracemalloc.start()
+
+    @staticmethod
+    def normalize(sql):
+        # SQLite only sees the first statement, which drops trailing comments
+        return ' '.join(sql.split(';')[0].split())
+
+    def add_template(self, name, query):
+        # placeholders (%s, %(name)s) match anything, including nothing with the spaces around them
+        parts = re.split(r' ?%(?:\(\w+\))?s ?', self.normalize(query))
+        pattern = ' ?.*? ?'.join(re.escape(part.replace('%%', '%')).replace('\\?', '.*?') for part in parts)
+        self.templates.append((name, re.compile(pattern)))
+
+    def template(self, sql):
+        """Return the name of the query template sql was made from."""
+        sql = self.normalize(sql)
+        for name, pattern in self.templates:
+            if pattern.fullmatch(sql):
+                return name
+        return 'other: %s' % sql[:60]
+
+    def statement(self, sql):
+        stats = self.statements.setdefault(self.template(sql), dict(count=0, seconds=0.0))
+        stats['count'] += 1
+
+    def add_time(self, template, seconds):
+        stats = self.statements.setdefault(template, dict(count=0, seconds=0.0))
+        stats['seconds'] += seconds
+        self.sql_seconds += seconds
+
+    def add_write(self, seconds):
+        self.write_seconds += seconds
+        self.writes += 1
+
+    def connect(self, database, **kwargs):
+        if not self.enabled:
+            return sqlite3.connect(database, **kwargs)
+        con = sqlite3.connect(database, factory=ProfilingConnection, **kwargs)
+        con.profiler = self
+        con.set_trace_callback(self.statement)
+        return con
+
+    def wrap_target(self, target):
+        if not self.enabled:
+            return target
+        return ProfilingTarget(target, self)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.trace_memory and self.depth == 1:
+            tracemalloc.reset_peak()
+        self.depth += 1
+        start, sql, write = time.perf_counter(), self.sql_seconds, self.write_seconds
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            phase = self.phases.setdefault(name, dict(seconds=0.0, sql=0.0, write=0.0))
+            phase['seconds'] += time.perf_counter() - start
+            phase['sql'] += self.sql_seconds - sql
+            phase['write'] += self.write_seconds - write
+            if self.trace_memory and self.depth == 1:
+                phase['peak_memory'] = tracemalloc.get_traced_memory()[1]
+
+    def report(self):
+        report = dict(phases=self.phases, statements=self.statements,
+                      sql_seconds=self.sql_seconds, write_seconds=self.write_seconds, writes=self.writes)
+        export = self.phases.get('export')
+        if export:
+            report['render_seconds'] = export['seconds'] - export['sql'] - export['write']
+        if self.trace_memory:
+            peaks = [phase['peak_memory'] for phase in self.phases.values() if 'peak_memory' in phase]
+            report['peak_memory'] = max(peaks + [tracemalloc.get_traced_memory()[1]])
+        return report
+
+    @staticmethod
+    def summary(report):
+        """Return a short human readable summary of report."""
+        phases = report['phases']
+        lines = ['profile: total %.3fs, connect %.3fs, load %.3fs, export %.3fs (render %.3fs), close %.3fs' % (
+            phases.get('total', {}).get('seconds', 0), phases.get('connect', {}).get('seconds', 0),
+            phases.get('load', {}).get('seconds', 0), phases.get('export', {}).get('seconds', 0),
+            report.get('render_seconds', 0), phases.get('close', {}).get('seconds', 0))]
+        lines.append('profile: %d statements in %.3fs, %d writes in %.3fs' % (
+            sum(stats['count'] for stats in report['statements'].values()), report['sql_seconds'],
+            report['writes'], report['write_seconds']))
+        top = sorted(report['statements'].items(), key=lambda item: item[1]['seconds'], reverse=True)
+        for name, stats in top[:5]:
+            lines.append('profile:   %-40s %8dx %8.3fs' % (name, stats['count'], stats['seconds']))
+        if 'peak_memory' in report:
+            lines.append('profile: peak memory %.1f MB' % (report['peak_memory'] / 1024 / 1024))
+        return lines
+
+    def finish(self, filename):
+        """Write the report to filename, log a summary and return the report."""
+        report = self.report()
+        if self.trace_memory:
+            tracemalloc.stop()
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1)
+        for line in self.summary(report):
+            logging.info(line)
+        logging.info("profile: report written to %s", filename)
+        return report
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class Progress(object):
+    """
+    Count exported areas, projects and tasks, and cancel the export on request.
+
+    Totals are the areas, projects and tasks the export visits: they are
+    counted from a BulkSource, or with COUNT_QUERY, which walks the tree like
+    the per-node queries (within the Selection), when the export starts.
+    report (if given) is called with a snapshot (see snapshot()) at most every
+    interval seconds, and once more when the export is done.
+    """
+
+    # a task in a project can be visited again below its header, so it's counted twice
+    COUNT_QUERY = """
+        WITH
+        area AS (
+            SELECT uuid FROM TMArea %(areas)s
+        ),
+        task AS (
+            SELECT uuid, type, area, project, actionGroup FROM TMTask
+            WHERE type IS NOT NULL
+            AND trashed = 0
+            AND status < 2
+            %(rows)s
+        ),
+        project AS (
+            SELECT uuid FROM task
+            WHERE type = 1
+            AND (area IN (SELECT uuid FROM area) OR area IS NULL AND (%(no_area)s))
+        ),
+        visit AS (
+            SELECT uuid, type FROM task
+            WHERE type != 1 AND project IS NULL AND area IN (SELECT uuid FROM area)
+            UNION ALL
+            SELECT uuid, type FROM task
+            WHERE type != 1 AND project IS NULL AND area IS NULL AND actionGroup IS NULL
+            AND %(inbox)d AND (%(no_area)s)
+            UNION ALL
+            SELECT uuid, type FROM task
+            WHERE type != 1 AND project IN (SELECT uuid FROM project)
+        )
+        SELECT (SELECT COUNT(*) FROM area) AS areas,
+               (SELECT COUNT(*) FROM project) AS projects,
+               (SELECT COUNT(*) FROM visit) + (
+                   SELECT COUNT(*) FROM visit AS header JOIN task ON task.actionGroup = header.uuid
+                   WHERE header.type = 2 AND task.type = 0) AS tasks;
+    """
+    KINDS = ('areas', 'projects', 'tasks')
+
+    def __init__(self, report=None, interval=0.25):
+        self.report = report
+        self.interval = interval
+        self.total = dict.fromkeys(self.KINDS, 0)
+        self.done = dict.fromkeys(self.KINDS, 0)
+        self.cancelled = threading.Event()
+        self.started = self.last_report = time.monotonic()
+
+    def start(self, con, selection=None, source=None):
+        if isinstance(source, BulkSource):
+            self.total.update(source.totals())
+        else:
+            s = selection or Selection()
+            row = con.execute(self.COUNT_QUERY % dict(areas=s.areas, rows=s.rows, no_area=s.no_area,
+                                                      inbox=int(s.inbox))).fetchone()
+            self.total.update(zip(self.KINDS, row))
+        self.started = self.last_report = time.monotonic()
+
+    def cancel(self):
+        """Stop the export at the next area, project or task (may be called from any thread)."""
+        self.cancelled.set()
+
+    def iterate(self, kind, rows):
+        for row in rows:
+            self.step(kind)
+            yield row
+
+    def step(self, kind):
+        """Count one exported item, report if it's time to, and stop if the export was cancelled."""
+        if self.cancelled.is_set():
+            raise ExportCancelled()
+        self.done[kind] += 1
+        if self.report and time.monotonic() - self.last_report >= self.interval:
+            self.last_report = time.monotonic()
+            self.report(self.snapshot())
+
+    def finish(self):
+        if self.report:
+            self.report(self.snapshot())
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done['tasks'] / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total['tasks'] - self.done['tasks'], 0)
+        return dict(done=dict(self.done), total=dict(self.total), elapsed=elapsed,
+                    tasks_per_second=rate, eta=remaining / rate if rate else None)
+
+
+class ProgressSource(object):
+    """Wrap a source to count the items it hands out, and to stop a cancelled export."""
+
+    def __init__(self, source, progress):
+        self.source = source
+        self.progress = progress
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def areas(self):
+        return self.progress.iterate('areas', self.source.areas())
+
+    def projects_in_area(self, uuid):
+        return self.progress.iterate('projects', self.source.projects_in_area(uuid))
+
+    def projects_without_area(self):
+        return self.progress.iterate('projects', self.source.projects_without_area())
+
+    def tasks_in_area_without_project(self, uuid):
+        return self.progress.iterate('tasks', self.source.tasks_in_area_without_project(uuid))
+
+    def tasks_in_inbox(self):
+        return self.progress.iterate('tasks', self.source.tasks_in_inbox())
+
+    def tasks_in_project(self, uuid):
+        return self.progress.iterate('tasks', self.source.tasks_in_project(uuid))
+
+    def tasks_in_action_group(self, uuid):
+        return self.progress.iterate('tasks', self.source.tasks_in_action_group(uuid))
+
+
+def sql_literal(value):
+    return "'%s'" % str(value).replace("'", "''")
+
+
+def sql_list(values):
+    return '(%s)' % ', '.join(sql_literal(value) for value in values)
+
+
+class Selection(object):
+    """
+    The part of the database to export (--area, --project, --inbox-only, --tag, --modified-since).
+
+    Areas, projects and the inbox select whole subtrees, and everything they
+    select is exported; without any of them, everything is. Tags and the
+    modification date select the tasks within these subtrees (headers stay).
+
+    Every selector becomes a condition in the WHERE clauses of the queries, so
+    unselected rows are never read. The conditions are empty strings if
+    nothing is selected, which leaves the queries as they are.
+    """
+
+    def __init__(self, args=None):
+        self.area_titles = list(getattr(args, 'areas', None) or [])
+        self.project_titles = list(getattr(args, 'projects', None) or [])
+        self.tag_titles = [tag[1:] if tag.startswith('@') else tag for tag in getattr(args, 'tags', None) or []]
+        self.inbox_only = getattr(args, 'inbox_only', False)
+        self.modified_since = parse_date(getattr(args, 'modified_since', None))
+        self.everything = not (self.area_titles or self.project_titles or self.inbox_only)
+        self.inbox = self.everything or self.inbox_only
+
+        # conditions on tasks (type 0), headers and projects pass
+        conditions = []
+        if self.tag_titles:
+            # a tag is given by its name in Things or as it is exported (make_tag), so match both
+            conditions.append("""AND (type != 0 OR uuid IN (
+                SELECT tt.tasks FROM TMTaskTag AS tt, TMTag AS tag
+                WHERE tt.tags = tag.uuid
+                AND (tag.title IN %s OR replace(replace(tag.title, ' ', '_'), '-', '_') IN %s)))""" % (
+                sql_list(self.tag_titles), sql_list(self.tag_titles)))
+        if self.modified_since is not None:
+            conditions.append("AND (type != 0 OR userModificationDate >= %r)" % self.modified_since)
+        self.tasks = '\n'.join(conditions)
+
+        if self.everything:
+            self.areas = self.projects = self.checklists = ''
+            self.area_tasks = self.rows = self.tasks
+            self.no_area = '1'
+            return
+
+        areas = sql_list(self.area_titles)
+        projects = sql_list(self.project_titles)
+        selected_projects = """
+            SELECT uuid FROM TMTask WHERE type = 1
+            AND (area IN (SELECT uuid FROM TMArea WHERE title IN %s) OR title IN %s)""" % (areas, projects)
+        # areas with a selected project are walked as well, but only for their selected projects
+        self.areas = """WHERE title IN %s OR uuid IN (
+            SELECT area FROM TMTask WHERE type = 1 AND trashed = 0 AND status < 2 AND title IN %s)""" % (
+            areas, projects)
+        self.projects = "AND (area IN (SELECT uuid FROM TMArea WHERE title IN %s) OR title IN %s)" % (
+            areas, projects)
+        self.area_tasks = "AND area IN (SELECT uuid FROM TMArea WHERE title IN %s)\n%s" % (areas, self.tasks)
+        # for reading all of TMTask at once: the same conditions, depending on where the row is exported
+        self.rows = """AND CASE
+            WHEN type = 1 THEN area IN (SELECT uuid FROM TMArea WHERE title IN %s) OR title IN %s
+            WHEN project IS NOT NULL THEN project IN (%s)
+            WHEN area IS NOT NULL THEN area IN (SELECT uuid FROM TMArea WHERE title IN %s)
+            WHEN actionGroup IS NOT NULL THEN actionGroup IN (
+                SELECT uuid FROM TMTask WHERE type = 2 AND project IN (%s))
+            ELSE %d END
+            %s""" % (areas, projects, selected_projects, areas, selected_projects, self.inbox, self.tasks)
+        self.checklists = """WHERE task IN (
+            SELECT uuid FROM TMTask WHERE type = 0 AND trashed = 0 AND status < 2
+            %s)""" % self.rows
+        # 'no area' is exported for the inbox and for selected projects without area
+        self.no_area = "%d OR EXISTS (SELECT 1 FROM TMTask WHERE type = 1 AND area IS NULL AND title IN %s)" % (
+            self.inbox, projects)
+
+    NO_AREA_QUERY = """
+        SELECT (%s) AS no_area_selected;
+    """
+
+    def no_area_selected(self, con):
+        return self.everything or bool(con.execute(self.NO_AREA_QUERY % self.no_area).fetchone()[0])
+
+    TAG_TITLES_QUERY = """
+        SELECT title FROM TMTag WHERE title IS NOT NULL;
+    """
+
+    def warn_unknown_tags(self, con):
+        """Log the given tags (--tag) that are no tag of the database, they select no task."""
+        if not self.tag_titles:
+            return
+        titles = [row[0] for row in con.execute(self.TAG_TITLES_QUERY)]
+        known = set(titles) | {make_tag(title)[1:] for title in titles}
+        for tag in self.tag_titles:
+            if tag not in known:
+                logging.error("there is no tag %s, no task is exported for it", tag)
+
+
+def parse_date(text):
+    """Return the timestamp of a date (YYYY-MM-DD, local time), or None."""
+    if not text:
+        return None
+    try:
+        return datetime.strptime(text, "%Y-%m-%d").timestamp()
+    except ValueError:
+        raise Exception("invalid date %s (expected YYYY-MM-DD)" % text)
+
+
+class QuerySource(object):
+    """
+    Fetch the children of each node with a separate query.
+
+    This is the original engine: it issues one query per area, project,
+    header, task (for tags) and task with checklist.
+    """
+
+    def __init__(self, con, selection=None):
+        self.con = con
+        self.cursor = con.cursor()
+        self.selection = selection or Selection()
+        self.make_tag = functools.lru_cache(maxsize=None)(make_tag)
+        # the filters of the selection are the same for the whole export, the uuids are bound
+        # parameters, so each query has one text and is prepared once (see CACHED_STATEMENTS)
+        s = self.selection
+        self.areas_query = Area.QUERY % s.areas
+        self.projects_in_area_query = Project.PROJECTS_IN_AREA % s.projects
+        self.projects_without_area_query = Project.PROJECTS_WITHOUT_AREA % s.projects
+        self.tasks_in_area_without_project_query = Task.TASKS_IN_AREA_WITHOUT_PROJECT % s.area_tasks
+        self.tasks_in_inbox_query = Task.TASKS_IN_INBOX % s.tasks
+        self.tasks_in_project_query = Task.TASKS_IN_PROJECT % s.tasks
+        self.tasks_in_action_group_query = Task.TASKS_IN_ACTION_GROUPS % s.tasks
+
+    def query(self, query, *parameters):
+        """Return all rows of query, so only one statement is open at any time."""
+        return self.cursor.execute(query, parameters).fetchall()
+
+    def no_area_selected(self):
+        return self.selection.no_area_selected(self.con)
+
+    def inbox_selected(self):
+        return self.selection.inbox
+
+    def areas(self):
+        return self.query(self.areas_query)
+
+    def area_tags(self, uuid):
+        return [self.make_tag(row['title']) for row in self.query(Area.TAGS_QUERY, uuid)]
+
+    def task_tags(self, uuid):
+        return [self.make_tag(row['title']) for row in self.query(RowObjectWithTags.TAGS_QUERY, uuid)]
+
+    def projects_in_area(self, uuid):
+        return self.query(self.projects_in_area_query, uuid)
+
+    def projects_without_area(self):
+        return self.query(self.projects_without_area_query)
+
+    def tasks_in_area_without_project(self, uuid):
+        return self.query(self.tasks_in_area_without_project_query, uuid)
+
+    def tasks_in_inbox(self):
+        return self.query(self.tasks_in_inbox_query)
+
+    def tasks_in_project(self, uuid):
+        return self.query(self.tasks_in_project_query, uuid)
+
+    def tasks_in_action_group(self, uuid):
+        return self.query(self.tasks_in_action_group_query, uuid)
+
+    def checklist_items(self, uuid):
+        return self.query(CheckListItem.items_of_task, uuid)
+
+
+class TagIndex(object):
+    """
+    Resolve the tags of all tasks and areas up front.
+
+    Every tag is formatted once (tag uuid -> token), and the tag uuids of
+    each task and area are collected from a single scan of TMTaskTag and
+    TMAreaTag, so looking up the tags of a node is a dict hit.
+    """
+
+    TAGS_QUERY = """
+        SELECT uuid, title FROM TMTag;
+    """
+    TASK_TAGS_QUERY = """
+        SELECT tasks AS uuid, tags AS tag FROM TMTaskTag ORDER BY rowid;
+    """
+    AREA_TAGS_QUERY = """
+        SELECT areas AS uuid, tags AS tag FROM TMAreaTag ORDER BY rowid;
+    """
+
+    def __init__(self, con):
+        c = con.cursor()
+        self.tokens = {row['uuid']: make_tag(row['title'])
+                       for row in c.execute(self.TAGS_QUERY) if row['title'] is not None}
+        self.task_tags = self.tag_ids(c.execute(self.TASK_TAGS_QUERY))
+        self.area_tags = self.tag_ids(c.execute(self.AREA_TAGS_QUERY))
+
+    def tag_ids(self, rows):
+        """Map uuid -> tuple of tag uuids, skipping tags that don't exist (like the join in TAGS_QUERY)."""
+        ids = {}
+        for row in rows:
+            if row['tag'] in self.tokens:
+                ids.setdefault(row['uuid'], []).append(row['tag'])
+        return {uuid: tuple(tags) for uuid, tags in ids.items()}
+
+    def tags_of_task(self, uuid):
+        return [self.tokens[tag] for tag in self.task_tags.get(uuid, ())]
+
+    def tags_of_area(self, uuid):
+        return [self.tokens[tag] for tag in self.area_tags.get(uuid, ())]
+
+
+class BulkSource(object):
+    """
+    Read TMArea, TMTask, the tag tables and TMChecklistItem once each, and
+    serve the children of each node from memory.
+
+    Every list is built with the same filter and order as the corresponding
+    query in QuerySource, so both engines produce identical output.
+    """
+
+    TASKS_QUERY = """
+        SELECT uuid, status, title, type, notes, area, dueDate, startDate, todayIndex, checklistItemsCount, stopDate,
+               project, actionGroup
+        FROM TMTask
+        WHERE type IS NOT NULL
+        AND trashed = 0
+        AND status < 2
+        %s
+        ORDER BY "index";
+    """
+    CHECKLIST_QUERY = """
+        SELECT uuid, title, status, task
+        FROM TMChecklistItem
+        %s
+        ORDER BY "index";
+    """
+
+    def __init__(self, con, selection=None):
+        c = con.cursor()
+        self.con = con
+        self.selection = selection or Selection()
+        self._areas = c.execute(Area.QUERY % self.selection.areas).fetchall()
+        self.tag_index = TagIndex(con)
+        self._checklist_items = self.group(c.execute(self.CHECKLIST_QUERY % self.selection.checklists), 'task')
+
+        self._projects_in_area = {}
+        self._projects_without_area = []
+        self._tasks_in_area_without_project = {}
+        self._tasks_in_inbox = []
+        self._tasks_in_project = {}
+        self._tasks_in_action_group = {}
+        for row in c.execute(self.TASKS_QUERY % self.selection.rows):
+            if row['type'] == Task.PROJECT:
+                if row['area'] is None:
+                    self._projects_without_area.append(row)
+                else:
+                    self._projects_in_area.setdefault(row['area'], []).append(row)
+                continue
+            if row['project'] is not None:
+                self._tasks_in_project.setdefault(row['project'], []).append(row)
+            elif row['area'] is not None:
+                self._tasks_in_area_without_project.setdefault(row['area'], []).append(row)
+            elif row['actionGroup'] is None:
+                self._tasks_in_inbox.append(row)
+            if row['type'] == Task.TASK and row['actionGroup'] is not None:
+                self._tasks_in_action_group.setdefault(row['actionGroup'], []).append(row)
+
+        # tasks without headers come first (ORDER BY type, "index")
+        for children in self._tasks_in_project.values():
+            children.sort(key=lambda row: row['type'])
+        for children in self._tasks_in_area_without_project.values():
+            children.sort(key=lambda row: row['type'])
+
+    @staticmethod
+    def group(rows, key):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[key], []).append(row)
+        return groups
+
+    def no_area_selected(self):
+        return self.selection.no_area_selected(self.con)
+
+    def inbox_selected(self):
+        return self.selection.inbox
+
+    def areas(self):
+        return self._areas
+
+    def area_tags(self, uuid):
+        return self.tag_index.tags_of_area(uuid)
+
+    def task_tags(self, uuid):
+        return self.tag_index.tags_of_task(uuid)
+
+    def projects_in_area(self, uuid):
+        return self._projects_in_area.get(uuid, [])
+
+    def projects_without_area(self):
+        return self._projects_without_area
+
+    def tasks_in_area_without_project(self, uuid):
+        return self._tasks_in_area_without_project.get(uuid, [])
+
+    def tasks_in_inbox(self):
+        return self._tasks_in_inbox
+
+    def tasks_in_project(self, uuid):
+        return self._tasks_in_project.get(uuid, [])
+
+    def tasks_in_action_group(self, uuid):
+        return self._tasks_in_action_group.get(uuid, [])
+
+    def checklist_items(self, uuid):
+        return self._checklist_items.get(uuid, [])
+
+    def totals(self):
+        """Return the number of areas, projects and tasks an export visits (see Progress)."""
+        no_area = self.no_area_selected()
+        projects = [row for area in self._areas for row in self.projects_in_area(area['uuid'])]
+        tasks = [row for area in self._areas for row in self.tasks_in_area_without_project(area['uuid'])]
+        if no_area:
+            projects += self._projects_without_area
+            if self.inbox_selected():
+                tasks += self._tasks_in_inbox
+        for project in projects:
+            tasks += self.tasks_in_project(project['uuid'])
+        below_headers = sum(len(self.tasks_in_action_group(row['uuid'])) for row in tasks
+                            if row['type'] == Task.ACTIONGROUP)
+        return dict(areas=len(self._areas), projects=len(projects), tasks=len(tasks) + below_headers)
+
+
+class UnitSource(BulkSource):
+    """
+    The rows below one area or project of a BulkSource, for a worker of export_parallel.
+
+    The main process loads the database once and sends each worker only the
+    rows (as dicts, which can be pickled) and tags of the file it renders.
+    """
+
+    def __init__(self, source, area_uuid, project_uuid=None):
+        self.con = None
+        self.selection = source.selection
+        self._areas = []
+        self._area_tags = {}
+        self._task_tags = {}
+        self._checklist_items = {}
+        self._projects_in_area = {}
+        self._projects_without_area = []
+        self._tasks_in_area_without_project = {}
+        self._tasks_in_inbox = []
+        self._tasks_in_project = {}
+        self._tasks_in_action_group = {}
+        if project_uuid is not None:
+            self.add_project(source, project_uuid)
+            return
+        self._area_tags[area_uuid] = source.area_tags(area_uuid)
+        if area_uuid == 'NULL':
+            if self.inbox_selected():
+                self.add_project(source, 'NULL')
+            projects = self._projects_without_area = [dict(row) for row in source.projects_without_area()]
+        else:
+            self._tasks_in_area_without_project[area_uuid] = self.add_tasks(
+                source, source.tasks_in_area_without_project(area_uuid))
+            projects = self._projects_in_area[area_uuid] = [dict(row) for row in source.projects_in_area(area_uuid)]
+        for row in projects:
+            self.add_project(source, row['uuid'])
+
+    def add_project(self, source, uuid):
+        if uuid == 'NULL':
+            self._tasks_in_inbox = self.add_tasks(source, source.tasks_in_inbox())
+        else:
+            self._task_tags[uuid] = source.task_tags(uuid)
+            self._tasks_in_project[uuid] = self.add_tasks(source, source.tasks_in_project(uuid))
+
+    def add_tasks(self, source, rows):
+        """Return rows as dicts, and take the tags, tasks below headers and checklist items of each."""
+        rows = [dict(row) for row in rows]
+        for row in rows:
+            uuid = row['uuid']
+            self._task_tags[uuid] = source.task_tags(uuid)
+            if row['type'] == Task.ACTIONGROUP:
+                self._tasks_in_action_group[uuid] = self.add_tasks(source, source.tasks_in_action_group(uuid))
+            elif row['checklistItemsCount']:
+                self._checklist_items[uuid] = [dict(item) for item in source.checklist_items(uuid)]
+        return rows
+
+    def area_tags(self, uuid):
+        return self._area_tags.get(uuid, [])
+
+    def task_tags(self, uuid):
+        return self._task_tags.get(uuid, [])
+
+
+def export_nodes(nodes, out, index=None):
+    """
+    Export nodes and everything below them, depth-first and without recursion.
+
+    The visit() of each node writes the node and returns its children, which
+    are pushed on an explicit work stack; the stack holds one entry per
+    level of the tree, and the children of a node are fetched in one batch
+    when it is visited. A file opened by a node is closed after its
+    children, or (like a with block would) when the export fails. Every
+    task is added to index (TaskIndexes) if given.
+    """
+    stack = [(None, iter(nodes), out, None)]  # (parent, its children, sink, own sink of the parent)
+    try:
+        while stack:
+            _, nodes, out, own_out = stack[-1]
+            node = next(nodes, None)
+            if node is not None:
+                children = node.visit(out)
+                if index is not None and isinstance(node, Task):
+                    index.add(node, *task_context(parent for parent, _, _, _ in stack))
+                if children is not None:
+                    nodes, out, own_out = children
+                    stack.append((node, iter(nodes), out, own_out))
+            else:
+                stack.pop()
+                if own_out is not None:
+                    own_out.close()
+    except BaseException:
+        exc_info = sys.exc_info()
+        for _, _, _, own_out in reversed(stack):
+            if own_out is not None:
+                own_out.__exit__(*exc_info)
+        raise
+
+
+def task_context(parents):
+    """Return the area and project (nodes) among parents, None for missing ones."""
+    area = project = None
+    for parent in parents:
+        if isinstance(parent, Area):
+            area = parent
+        elif isinstance(parent, Project):
+            project = parent
+    return area, project
+
+
+def context_title(area, project):
+    """Return 'Area / Project' for the nodes of task_context(), without 'no area'."""
+    titles = []
+    if area is not None and area.uuid != 'NULL':
+        titles.append(area.title)
+    if project is not None:
+        titles.append(project.title)
+    return ' / '.join(titles)
+
+
+def target_base(args):
+    """Return the target without the extension of a single file format, to name files next to it."""
+    base = args.target
+    extension = SINGLE_FILE_FORMATS.get(args.format)
+    if extension and base.endswith(extension):
+        base = base[:-len(extension)]
+    return base
+
+
+class TaskIndexes(list):
+    """The indexes (PerspectiveIndex, SearchIndex) every exported task is added to."""
+
+    @classmethod
+    def from_args(cls, args):
+        """Return the indexes asked for by args, or None."""
+        indexes = cls()
+        if getattr(args, 'perspectives', False):
+            indexes.append(PerspectiveIndex())
+        if getattr(args, 'search_index', None) is not None:
+            indexes.append(SearchIndex(args))
+        return indexes or None
+
+    def add(self, task, area, project):
+        for index in self:
+            index.add(task, area, project)
+
+    def write(self, target, args, profiler):
+        try:
+            for index in self:
+                with profiler.phase(index.PHASE):
+                    index.write(target, args)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        for index in self:
+            index.abort()
+
+
+class PerspectiveIndex(object):
+    """
+    Collect the tasks of the perspective files while the tree is exported (--perspectives).
+
+    Today and Someday list the tasks with these attributes, Upcoming the tasks
+    with a start or due date under each of their dates, and the file of each
+    tag the tasks with that tag. Tasks are listed with their tags and
+    attributes (without notes and checklists) below the area / project they
+    belong to, in export order. The files are written to a folder next to
+    the target.
+    """
+
+    FOLDER_TMPL = "%s perspectives"
+    TAG_FOLDER = 'tags'
+    TODAY = 'Today'
+    UPCOMING = 'Upcoming'
+    SOMEDAY = 'Someday'
+
+    def __init__(self):
+        # perspective -> group (area / project or date) -> lines
+        self.perspectives = {self.TODAY: {}, self.UPCOMING: {}, self.SOMEDAY: {}}
+        self.tags = {}  # tag -> group -> lines
+
+    PHASE = 'perspectives'
+
+    def add(self, task, area, project):
+        if task.type == Task.ACTIONGROUP:
+            return
+        line = Task.TASK_TEMPLATE % (indent_of(1), task.title, task.tags)
+        group = context_title(area, project)
+        if task.todayIndex:
+            perspective = self.TODAY if task.startDate else self.SOMEDAY
+            self.perspectives[perspective].setdefault(group, []).append(line)
+        else:
+            for date in sorted({format_date(task.startDate), format_date(task.dueDate)} - {None}):
+                self.perspectives[self.UPCOMING].setdefault(date, []).append(line)
+        attributes = task.attributes()
+        for tag in task._tags:
+            if tag not in attributes:
+                self.tags.setdefault(tag, {}).setdefault(group, []).append(line)
+
+    def write(self, target, args):
+        folder = self.FOLDER_TMPL % target_base(args)
+        target.makedirs(folder)
+        for name, groups in self.perspectives.items():
+            self.write_file(target, folder, name, groups, sort=name == self.UPCOMING)
+        if self.tags:
+            tag_folder = os.path.join(folder, self.TAG_FOLDER)
+            target.makedirs(tag_folder)
+            for tag, groups in self.tags.items():
+                self.write_file(target, tag_folder, tag[1:], groups)
+
+    @staticmethod
+    def write_file(target, folder, name, groups, sort=False):
+        with target.open(RowObject.FILE_TMPL % name, folder) as out:
+            for group in sorted(groups) if sort else groups:
+                out.writeline("%s:" % (group or 'Inbox'))
+                out.write(''.join(line + '\n' for line in groups[group]))
+
+    def abort(self):
+        pass  # the files are written to the target, which is aborted with the export
+
+
+class SearchIndex(object):
+    """
+    Write a full-text search index of the exported tasks next to the target (--search-index).
+
+    The index is an SQLite database with one FTS5 table: the title, notes
+    (as plain text), tags and 'Area / Project' of every task, and the file
+    it was exported to. The rows are inserted in batches into a partial
+    file in a single transaction while the tree is exported, and the
+    partial file replaces the index when the export is complete. search()
+    queries it (--search).
+    """
+
+    PHASE = 'search index'
+    PATH_TMPL = "%s.search.sqlite"
+    PARTIAL_TMPL = "%s.part"
+    BATCH_SIZE = 1000
+
+    SCHEMA = """
+        CREATE VIRTUAL TABLE tasks USING fts5(title, notes, tags, context, file UNINDEXED, uuid UNINDEXED);
+    """
+    INSERT = "INSERT INTO tasks (title, notes, tags, context, file, uuid) VALUES (?, ?, ?, ?, ?, ?);"
+    OPTIMIZE = "INSERT INTO tasks (tasks) VALUES ('optimize');"
+
+    def __init__(self, args):
+        self.args = args
+        self.path = args.search_index or self.PATH_TMPL % target_base(args)
+        if args.format != RowObject.FMT_ALL:
+            self.filename = None
+        elif args.stdout:
+            self.filename = '-'
+        else:
+            self.filename = args.target
+            if not self.filename.endswith(SINGLE_FILE_FORMATS[args.format]):
+                self.filename += SINGLE_FILE_FORMATS[args.format]
+        self.partial = self.PARTIAL_TMPL % self.path
+        if os.path.exists(self.partial):
+            os.remove(self.partial)  # left over from an export that was killed
+        self.con = sqlite3.connect(self.partial)
+        # the partial file only replaces the index once it is complete
+        self.con.execute("PRAGMA journal_mode = OFF;")
+        self.con.execute("PRAGMA synchronous = OFF;")
+        try:
+            self.con.execute(self.SCHEMA)
+        except sqlite3.OperationalError:
+            self.abort()
+            raise Exception("this SQLite has no FTS5, can't write a search index")
+        self.rows = []
+        self.last = (None, None, None)  # area, project, file
+
+    def file_of(self, area, project):
+        """Return the file the tasks of area and project are exported to, None if they aren't."""
+        if self.last[:2] != (area, project):
+            # tasks come project by project, build the path once for each
+            self.last = (area, project, self.build_file_of(area, project))
+        return self.last[2]
+
+    def build_file_of(self, area, project):
+        if self.args.format == RowObject.FMT_ALL:
+            return self.filename
+        elif self.args.format == RowObject.FMT_AREA:
+            return output_path(RowObject.FILE_TMPL % area.title, self.args.target)
+        elif project is not None:
+            return output_path(RowObject.FILE_TMPL % project.title, os.path.join(self.args.target, area.title))
+        return None  # format project has no file for the tasks directly in areas
+
+    def add(self, task, area, project):
+        if task.type == Task.ACTIONGROUP:
+            return
+        filename = self.file_of(area, project)
+        if filename is None:
+            return
+        notes = RowObject.clean_notes(task.notes) if task.notes else ''
+        self.rows.append((task.title, notes, task.tags.strip(), context_title(area, project), filename, task.uuid))
+        if len(self.rows) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.con.executemany(self.INSERT, self.rows)
+        self.rows = []
+
+    def write(self, target, args):
+        self.flush()
+        self.con.execute(self.OPTIMIZE)
+        self.con.commit()
+        self.con.close()
+        self.con = None
+        os.replace(self.partial, self.path)
+
+    def abort(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+            if os.path.exists(self.partial):
+                os.remove(self.partial)
+
+
+SEARCH_QUERY = """
+    SELECT title, snippet(tasks, 1, '[', ']', '...', 12) AS notes, tags, context, file
+    FROM tasks
+    WHERE tasks MATCH ?
+    ORDER BY rank
+    LIMIT ?;
+"""
+
+
+def search(path, query, limit=50):
+    """Return the best matches of query (FTS5 syntax) in the search index at path, best first."""
+    if not os.path.exists(path):
+        raise Exception("no search index at %s (export with --search-index first)" % path)
+    con = connect_read_only(path)
+    try:
+        return con.execute(SEARCH_QUERY, (query, limit)).fetchall()
+    finally:
+        con.close()
+
+
+INDENTS = ["\t" * level for level in range(8)]
+
+
+def indent_of(level):
+    """Return the indent of level, the strings are built once and shared by all nodes."""
+    while len(INDENTS) <= level:
+        INDENTS.append("\t" * len(INDENTS))
+    return INDENTS[level]
+
+
+class TreeExport(object):
+    """
+    Export the whole tree from a single recursive query (--engine tree).
+
+    QUERY returns every area, project, task and checklist item in output
+    order, with its depth (in format all), its kind and its tags, so the rows
+    are streamed to the output without building the tree in Python. SQLite
+    sorts the rows in temporary storage, which is kept on disk (see
+    STREAM_PRAGMAS). The children of each node are selected with the same
+    filter and order as the per-node queries; 'no area' and the inbox are
+    added as rows of their own.
+    """
+
+    NO_AREA = 'NULL'
+    INBOX = 'NULL/inbox'
+    TAG_SEPARATOR = '\x1f'
+
+    # parent_kind is the kind a node must have to get the row as child: area, project, header
+    # or task (a task with checklist); the recursive select is ordered by path, so the
+    # queue is a priority queue that yields the rows depth-first in output order
+    QUERY = """
+        WITH RECURSIVE
+        task AS (
+            SELECT uuid, status, title, type, notes, area, project, actionGroup,
+                   dueDate, startDate, todayIndex, checklistItemsCount, stopDate, "index"
+            FROM TMTask
+            WHERE type IS NOT NULL
+            AND trashed = 0
+            AND status < 2
+            %(rows)s
+        ),
+        edge (parent_kind, parent, kind, grp, type_order, "index", uuid, status, title, type, notes,
+              dueDate, startDate, todayIndex, checklistItemsCount, stopDate) AS (
+            SELECT 'root', NULL, 'area', 0, 0, 0, 'NULL', NULL, 'no area', NULL, NULL,
+                   NULL, NULL, NULL, NULL, NULL
+            WHERE %(no_area)s
+            UNION ALL
+            SELECT 'root', NULL, 'area', 1, 0, "index", uuid, NULL, title, NULL, NULL,
+                   NULL, NULL, NULL, NULL, NULL
+            FROM TMArea %(areas)s
+            UNION ALL
+            SELECT 'area', 'NULL', 'project', 0, 0, 0, 'NULL/inbox', 0, 'Inbox', 1, NULL,
+                   NULL, NULL, NULL, 0, NULL
+            WHERE %(inbox)s
+            UNION ALL
+            SELECT 'area', coalesce(area, 'NULL'), 'project', 1, 0, "index", uuid, status, title, type, notes,
+                   dueDate, startDate, todayIndex, checklistItemsCount, stopDate
+            FROM task WHERE type = 1
+            UNION ALL
+            SELECT 'area', area, 'task', 0, type, "index", uuid, status, title, type, notes,
+                   dueDate, startDate, todayIndex, checklistItemsCount, stopDate
+            FROM task WHERE type != 1 AND area IS NOT NULL AND project IS NULL
+            UNION ALL
+            SELECT 'project', 'NULL/inbox', 'task', 0, 0, "index", uuid, status, title, type, notes,
+                   dueDate, startDate, todayIndex, checklistItemsCount, stopDate
+            FROM task WHERE type != 1 AND project IS NULL AND area IS NULL AND actionGroup IS NULL
+            UNION ALL
+            SELECT 'project', project, 'task', 0, type, "index", uuid, status, title, type, notes,
+                   dueDate, startDate, todayIndex, checklistItemsCount, stopDate
+            FROM task WHERE type != 1 AND project IS NOT NULL
+            UNION ALL
+            SELECT 'header', actionGroup, 'task', 0, 0, "index", uuid, status, title, type, notes,
+                   dueDate, startDate, todayIndex, checklistItemsCount, stopDate
+            FROM task WHERE type = 0 AND actionGroup IS NOT NULL
+            UNION ALL
+            SELECT 'task', task, 'checklist', 0, 0, "index", uuid, status, title, NULL, NULL,
+                   NULL, NULL, NULL, NULL, NULL
+            FROM TMChecklistItem %(checklists)s
+        ),
+        node AS (
+            SELECT *, printf('%%08d', row_number() OVER (
+                       PARTITION BY parent_kind, parent ORDER BY grp, type_order, "index")) AS position,
+                   CASE WHEN kind != 'task' THEN kind
+                        WHEN type = 2 THEN 'header'
+                        WHEN checklistItemsCount THEN 'task' END AS child_kind
+            FROM edge
+        ),
+        tree (path, depth, kind, child_kind, uuid, status, title, type, notes,
+              dueDate, startDate, todayIndex, checklistItemsCount, stopDate) AS (
+            SELECT position, 0, kind, child_kind, uuid, status, title, type, notes,
+                   dueDate, startDate, todayIndex, checklistItemsCount, stopDate
+            FROM node WHERE parent_kind = 'root'
+            UNION ALL
+            SELECT tree.path || node.position, tree.depth + 1, node.kind, node.child_kind, node.uuid, node.status,
+                   node.title, node.type, node.notes, node.dueDate, node.startDate, node.todayIndex,
+                   node.checklistItemsCount, node.stopDate
+            FROM tree JOIN node ON node.parent_kind = tree.child_kind AND node.parent = tree.uuid
+            ORDER BY 1
+        )
+        SELECT kind, depth, uuid, status, title, type, notes,
+               dueDate, startDate, todayIndex, checklistItemsCount, stopDate,
+               CASE kind
+               WHEN 'area' THEN (
+                   SELECT group_concat(tag, char(31)) FROM (
+                       SELECT tag.title AS tag
+                       FROM TMAreaTag AS at, TMTag AS tag
+                       WHERE at.areas = tree.uuid
+                       AND at.tags = tag.uuid
+                       ORDER BY at.rowid))
+               WHEN 'checklist' THEN NULL
+               ELSE (
+                   SELECT group_concat(tag, char(31)) FROM (
+                       SELECT tag.title AS tag
+                       FROM TMTaskTag AS tt, TMTag AS tag
+                       WHERE tt.tasks = tree.uuid
+                       AND tt.tags = tag.uuid
+                       ORDER BY tt.rowid))
+               END AS tags
+        FROM tree;
+    """
+
+    # the window function and the queue of the recursive select are kept in temporary
+    # storage, which grows with the database: keep it in a temporary file, and the page
+    # cache small and unmapped (instead of Snapshot.READ_PRAGMAS) for this one pass
+    STREAM_PRAGMAS = """
+        PRAGMA mmap_size = 0;
+        PRAGMA cache_size = -2000;
+        PRAGMA temp_store = FILE;
+    """
+
+    PROGRESS_KINDS = dict(area='areas', project='projects', task='tasks')
+
+    def __init__(self, con, args, target, progress=None, selection=None, index=None):
         self.con = con
         self.args = args
-        self.level = level
+        self.target = target
+        self.progress = progress
+        self.selection = selection or Selection()
+        self.index = index
+        self.make_tag = functools.lru_cache(maxsize=None)(make_tag)
+
+    def rows(self):
+        s = self.selection
+        self.con.executescript(self.STREAM_PRAGMAS)
+        rows = self.con.execute(self.QUERY % dict(rows=s.rows, areas=s.areas, no_area=s.no_area, inbox=int(s.inbox),
+                                                  checklists=s.checklists))
+        if self.progress is None:
+            return rows
+        return self.counted(rows)
+
+    def counted(self, rows):
+        for row in rows:
+            kind = self.PROGRESS_KINDS.get(row['kind'])
+            if kind is not None and row['uuid'] not in (self.NO_AREA, self.INBOX):
+                self.progress.step(kind)
+            yield row
+
+    def export(self, out):
+        """Write the rows to out (format all) or to the files of the areas or projects."""
+        args = self.args
+        area = None
+        item_out = out  # receives tasks and checklist items, None while an unchanged file is skipped
+        offset = 0  # in format area and project, projects and their contents move one level up
+        file_out = None
+        try:
+            for row in self.rows():
+                kind = row['kind']
+                level = row['depth'] - offset
+                if kind == 'area':
+                    if file_out is not None:
+                        file_out.close()
+                        file_out = None
+                    offset = 0
+                    area = Area(row, None, args, self.target)
+                    project = None
+                    area.add_tags(self.split_tags(row))
+                    if args.format == RowObject.FMT_ALL:
+                        out.writeline(area.PROJECT_TEMPLATE % (area.indent, area.title, area.tags))
+                    elif args.format == RowObject.FMT_AREA:
+                        area.path = args.target
+                        self.target.makedirs(area.path)
+                        item_out = None
+                        if not self.target.unchanged(area.FILE_TMPL % area.title, area.path, ('area', area.uuid)):
+                            item_out = file_out = area.open_file(self.target, area.path)
+                    else:
+                        area.path = os.path.join(args.target, area.title)
+                        self.target.makedirs(area.path)
+                        item_out = NullSink()  # tasks directly in areas are not exported to any file
+                elif kind == 'project':
+                    inbox = row['uuid'] == self.INBOX
+                    if args.format != RowObject.FMT_ALL and not inbox:
+                        offset = 1
+                        level = 0
+                    project = Project(row, None, args, level, area)
+                    if inbox:
+                        project.uuid = self.NO_AREA
+                    project.add_tags(self.split_tags(row))
+                    project.add_attributes()
+                    if args.format == RowObject.FMT_PROJECT:
+                        if file_out is not None:
+                            file_out.close()
+                            file_out = None
+                        item_out = None
+                        if not self.target.unchanged(project.FILE_TMPL % project.title, area.path,
+                                                     ('project', project.uuid)):
+                            item_out = file_out = project.open_file(self.target, area.path)
+                    elif item_out is not None:
+                        item_out.writeline(project.PROJECT_TEMPLATE % (project.indent, project.title, project.tags))
+                    if item_out is not None and project.notes:
+                        project.print_notes(item_out)
+                elif item_out is None:
+                    continue
+                elif kind == 'task':
+                    task = Task(row, None, args, level)
+                    task.add_tags(self.split_tags(row))
+                    task.add_attributes()
+                    task.write(item_out)
+                    if self.index is not None:
+                        self.index.add(task, area, project)
+                else:
+                    CheckListItem(row, None, args, level).export(item_out)
+            if file_out is not None:
+                file_out.close()
+        except BaseException:
+            if file_out is not None:
+                file_out.__exit__(*sys.exc_info())
+            raise
+
+    def split_tags(self, row):
+        return [self.make_tag(title) for title in self.tag_titles(row)]
+
+    def tag_titles(self, row):
+        tags = row['tags']
+        return tags.split(self.TAG_SEPARATOR) if tags else ()
+
+
+class RecordExport(object):
+    """
+    Write one flat record per task and checklist item (format jsonl and csv).
 
-    def __getattr__(self, name):
-        return self.row[name]
+    The records are built from the rows of TreeExport.QUERY while they are
+    streamed; only the rows above the current one are kept to tell its area,
+    project, header and task, so memory use doesn't grow with the database.
+    """
 
-    def __getitem__(self, name):
-        return getattr(self, name)
+    FIELDS = ('kind', 'uuid', 'title', 'status', 'area', 'project', 'header', 'task', 'tags', 'notes',
+              'due', 'start', 'done', 'when', 'dueDate', 'startDate', 'stopDate', 'todayIndex')
+    CSV_TAG_SEPARATOR = ', '
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def records(self):
+        parents = []  # the rows from the area down to the current row, indexed by depth
+        for row in self.tree.rows():
+            del parents[row['depth']:]
+            parents.append(row)
+            kind = row['kind']
+            if kind == 'checklist' or (kind == 'task' and row['type'] != Task.ACTIONGROUP):
+                yield self.record(row, parents)
+
+    def record(self, row, parents):
+        context = dict(area=None, project=None, header=None, task=None)
+        for parent in parents[:-1]:
+            kind = parent['kind']
+            if kind == 'task':
+                kind = 'header' if parent['type'] == Task.ACTIONGROUP else 'task'
+            if parent['uuid'] not in (self.tree.NO_AREA, self.tree.INBOX):
+                context[kind] = parent['title']
+        record = dict(kind=row['kind'], uuid=row['uuid'], title=row['title'], status=row['status'], **context)
+        if row['kind'] == 'checklist':
+            record.update(tags=[], notes=None, due=None, start=None, done=None, when=None,
+                          dueDate=None, startDate=None, stopDate=None, todayIndex=None)
+            return record
+        todayIndex, startDate = row['todayIndex'], row['startDate']
+        when = None
+        if todayIndex:
+            when = 'today' if startDate else 'someday'
+        record.update(tags=list(self.tree.tag_titles(row)),
+                      notes=RowObject.clean_notes(row['notes']) if row['notes'] else None,
+                      due=format_date(row['dueDate']), start=format_date(startDate),
+                      done=format_date(row['stopDate']), when=when,
+                      dueDate=row['dueDate'], startDate=startDate, stopDate=row['stopDate'], todayIndex=todayIndex)
+        return record
+
+    def export(self, out, fmt):
+        if fmt == RowObject.FMT_JSONL:
+            for record in self.records():
+                out.writeline(json.dumps(record, ensure_ascii=False))
+        else:
+            writer = csv.writer(out, lineterminator='\n')
+            writer.writerow(self.FIELDS)
+            for record in self.records():
+                record['tags'] = self.CSV_TAG_SEPARATOR.join(record['tags'])
+                writer.writerow([record[name] for name in self.FIELDS])
 
-    TEMPLATE = '%s%s'
 
-    def indent_(self, level):
-        return "\t" * level
+class RowObject(object):
+    """
+    A node of the exported tree.
 
-    @property
-    def indent(self):
-        return self.indent_(self.level)
+    The FIELDS of the row are copied into slots when the node is created, the
+    row itself is not kept. Templates are formatted with positional values.
+    """
+    __slots__ = ('source', 'args', 'level', 'indent', 'uuid', 'title')
+
+    PROJECT_TEMPLATE = "\n%s%s:%s"
+    FMT_ALL = 'all'
+    FMT_PROJECT = 'project'
+    FMT_AREA = 'area'
+    FMT_JSONL = 'jsonl'
+    FMT_CSV = 'csv'
+    FIELDS = ('uuid', 'title')
+
+    def __init__(self, row, source, args, level=0):
+        for name in self.FIELDS:
+            setattr(self, name, row[name])
+        self.source = source
+        self.args = args
+        self.level = level
+        self.indent = indent_of(level)
+
+    def as_row(self):
+        """Return the fields as a dict, which can be pickled and turned into the node again."""
+        return {name: getattr(self, name) for name in self.FIELDS}
 
     @property
     def notes_indent(self):
-        return self.indent_(self.level + 1)
+        return indent_of(self.level + 1)
 
     @property
     def tags(self):
         return ''  # tags are empty for some items
 
-    URL = re.compile("\<a href=\"(?P<url>.*)?\"\>.*?\<\/a\>")
+    # links are replaced by their url; neither part spans lines, like the notes were matched line by line
+    URL = re.compile("<a href=\"(?P<url>[^\"\n]*)\">.*?</a>")
 
-    def print_notes(self):
-        notes = self.notes
+    @classmethod
+    def clean_notes(cls, notes):
+        """Return the notes as plain text: without the legacy xml wrapper, links replaced by their url."""
         if notes.startswith("<note xml:space=\"preserve\">"):
             notes = notes[27:-7]
-        for line in notes.split("\n"):
-            line = self.URL.sub(lambda m: m.group('url'), line)
-            print('%s%s' % (self.notes_indent, line))
-
-    def find_and_export_items(self, klass, query):
-        c = self.con.cursor()
-        for row in c.execute(query):
-            item = klass(row, self.con, self.args, self.level + 1)
-            item.export()
+        if '<a href' in notes:
+            notes = cls.URL.sub(r'\g<url>', notes)
+        return notes
+
+    def print_notes(self, out):
+        """Write the notes indented below the item, in a single write."""
+        notes = self.clean_notes(self.notes)
+        notes_indent = self.notes_indent
+        out.write(notes_indent + notes.replace("\n", "\n" + notes_indent) + "\n")
+
+    def export(self, out, index=None):
+        """Export this item and everything below it."""
+        export_nodes([self], out, index)
+
+    def visit(self, out):
+        """
+        Write the item itself and return its children as (nodes, sink, own sink),
+        or None if it has none; own sink (an opened file) is closed after the children.
+        """
+        raise NotImplementedError
+
+    def children(self, klass, rows):
+        return (klass(row, self.source, self.args, self.level + 1) for row in rows)
 
     FILE_TMPL = "%s.taskpaper"
 
-    def reroute_stdout(self, path_prefix):
-        filename = self.FILE_TMPL % self.title
-        reroute_stdout(filename, path_prefix)
-
-    def makedirs(self):
-        if not os.path.exists(self.path):
-            os.makedirs(self.path)
+    def open_file(self, target, path_prefix):
+        """Open the output file for this item."""
+        return target.open(self.FILE_TMPL % self.title, path_prefix)
 
 
 class RowObjectWithTags(RowObject):
+    __slots__ = ('_tags',)
 
     TAGS_QUERY = """
         SELECT tag.title AS title FROM TMTaskTag AS tt, TMTag AS tag
-        WHERE tt.tasks = '%s'
-        AND tt.tags = tag.uuid;
+        WHERE tt.tasks = ?
+        AND tt.tags = tag.uuid
+        ORDER BY tt.rowid;
     """
 
-    def __init__(self, row, con, args, level=0):
-        super().__init__(row, con, args, level)
-        self._tags = []
+    def __init__(self, row, source, args, level=0):
+        super().__init__(row, source, args, level)
+        self._tags = {}  # used as an ordered set
 
     @property
     def tags(self):
@@ -148,95 +2668,119 @@ class RowObjectWithTags(RowObject):
         return ' ' + ' '.join(self._tags)
 
     def add_tag(self, tag):
-        if tag not in self._tags:
-            self._tags.append(tag)
+        self._tags[tag] = None
+
+    def add_tags(self, tags):
+        self._tags.update(dict.fromkeys(tags))
 
     def load_tags_from_db(self):
-        def make_tag(title):
-            return '@' + title.replace(' ', '_').replace('-', '_')
+        self.add_tags(self.source_tags())
 
-        c = self.con.cursor()
-        for row in c.execute(self.TAGS_QUERY % self.uuid):
-            self.add_tag(make_tag(row['title']))
+    def source_tags(self):
+        return self.source.task_tags(self.uuid)
 
 
 class TaskObjects(RowObjectWithTags):
+    __slots__ = ('status', 'type', 'notes', 'dueDate', 'startDate', 'todayIndex', 'checklistItemsCount', 'stopDate')
 
     task_fields = """
         SELECT uuid, status, title, type, notes, area, dueDate, startDate, todayIndex, checklistItemsCount, stopDate
         FROM TMTask
     """
+    FIELDS = ('uuid', 'status', 'title', 'type', 'notes', 'dueDate', 'startDate', 'todayIndex',
+              'checklistItemsCount', 'stopDate')
 
     def add_attributes(self):
         """Add all attributes (due date, start date, today, someday etc.) as tags."""
+        for tag in self.attributes():
+            self.add_tag(tag)
+
+    def attributes(self):
+        attributes = []
         if self.dueDate:
-            self.add_tag('@due(%s)' % datetime.fromtimestamp(self.dueDate).strftime("%Y-%m-%d"))
+            attributes.append('@due(%s)' % format_date(self.dueDate))
         if self.todayIndex:
             if self.startDate:
-                self.add_tag('@today')
+                attributes.append('@today')
             else:
-                self.add_tag('@someday')
+                attributes.append('@someday')
         elif self.startDate:
-            self.add_tag('@startDate(%s)' % datetime.fromtimestamp(self.startDate).strftime("%Y-%m-%d"))
+            attributes.append('@startDate(%s)' % format_date(self.startDate))
         if self.stopDate:
-            self.add_tag('@done(%s)' % datetime.fromtimestamp(self.stopDate).strftime("%Y-%m-%d"))
+            attributes.append('@done(%s)' % format_date(self.stopDate))
+        return attributes
 
 
 class Area(RowObjectWithTags):
+    __slots__ = ('target', 'path')
+
     QUERY = """
-        SELECT uuid, title FROM TMArea ORDER BY "index";
+        SELECT uuid, title FROM TMArea %s ORDER BY "index";
     """
 
     TAGS_QUERY = """
         SELECT tag.title AS title FROM TMAreaTag AS at, TMTag AS tag
-        WHERE at.areas = '%s'
-        AND at.tags = tag.uuid;
+        WHERE at.areas = ?
+        AND at.tags = tag.uuid
+        ORDER BY at.rowid;
     """
 
-    def export(self):
-        logging.debug("Area: %s (%s)", self.title, self.uuid)
+    def __init__(self, row, source, args, target):
+        super().__init__(row, source, args)
+        self.target = target
+        self.path = None
+
+    def source_tags(self):
+        return self.source.area_tags(self.uuid)
+
+    def visit(self, out):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Area: %s (%s)", self.title, self.uuid)
         self.load_tags_from_db()
         if self.args.format == RowObject.FMT_ALL:
-            next_level = 1
-            print(self.PROJECT_TEMPLATE % self)
+            out.writeline(self.PROJECT_TEMPLATE % (self.indent, self.title, self.tags))
+            return self.contents(1), out, None
         elif self.args.format == RowObject.FMT_AREA:
-            # reroute stdout to a file for this area
+            # one file for this area
             self.path = self.args.target
-            self.makedirs()
-            self.reroute_stdout(self.args.target)
-            next_level = 0
+            self.target.makedirs(self.path)
+            if self.target.unchanged(self.FILE_TMPL % self.title, self.path, ('area', self.uuid)):
+                return None
+            area_out = self.open_file(self.target, self.path)
+            return self.contents(0), area_out, area_out
         else:
-            # set path and make folder for area
+            # set path and make folder for area, each project opens its own file
             self.path = os.path.join(self.args.target, self.title)
-            self.makedirs()
-            next_level = 0
+            self.target.makedirs(self.path)
+            return self.contents(0), out, None
 
-        c = self.con.cursor()
+    def contents(self, next_level):
+        """Yield the tasks directly in this area, then its projects."""
+        if self.uuid != 'NULL':
+            yield from self.children(Task, self.source.tasks_in_area_without_project(self.uuid))
+        yield from self.projects(next_level)
 
+    def projects(self, next_level):
+        """Yield the projects of this area, the area 'no area' starts with the inbox."""
         if self.uuid == 'NULL':
-            inbox = Project(dict(uuid='NULL', title='Inbox',
-                                 dueDate=None, startDate=None, stopDate=None, todayIndex=None, notes=None),
-                            self.con, self.args, self.level + 1, self)
-            inbox.export()
-            query = Project.PROJECTS_WITHOUT_AREA
+            if self.source.inbox_selected():
+                yield Project(Project.INBOX_ROW, self.source, self.args, self.level + 1, self)
+            rows = self.source.projects_without_area()
         else:
-            self.find_and_export_items(Task, Task.TASKS_IN_AREA_WITHOUT_PROJECT % self.uuid)
-            query = Project.PROJECTS_IN_AREA % self.uuid
-
-        for row in c.execute(query):
-            p = Project(row, self.con, self.args, next_level, self)
-            p.export()
-
-        if self.args.format == RowObject.FMT_AREA:
-            sys.stdout = sys.__stdout__
+            rows = self.source.projects_in_area(self.uuid)
+        for row in rows:
+            yield Project(row, self.source, self.args, next_level, self)
 
 
 class Project(TaskObjects):
+    __slots__ = ('area',)
+
     PROJECTS_IN_AREA = TaskObjects.task_fields + """
         WHERE type=1
-        AND area="%s"
+        AND area = ?
         AND trashed = 0
         AND status < 2 -- not canceled
+        %s
         ORDER BY "index";
     """
     PROJECTS_WITHOUT_AREA = TaskObjects.task_fields + """
@@ -244,49 +2788,56 @@ class Project(TaskObjects):
         AND area is NULL
         AND trashed = 0
         AND status < 2 -- not canceled
+        %s
         ORDER BY "index";
     """
+    INBOX_ROW = dict(uuid='NULL', title='Inbox', status=0, type=1, notes=None,
+                     dueDate=None, startDate=None, todayIndex=None, checklistItemsCount=0, stopDate=None)
 
-    def __init__(self, row, con, args, level, area):
-        super().__init__(row, con, args, level)
+    def __init__(self, row, source, args, level, area):
+        super().__init__(row, source, args, level)
         self.area = area
 
-    def export(self):
-        logging.debug("Project: %s (%s)", self.title, self.uuid)
+    def visit(self, out):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Project: %s (%s)", self.title, self.uuid)
         self.load_tags_from_db()
         self.add_attributes()
+        project_out = None
         if self.args.format == RowObject.FMT_PROJECT:
-            self.reroute_stdout(self.area.path)
+            if self.area.target.unchanged(self.FILE_TMPL % self.title, self.area.path, ('project', self.uuid)):
+                return None
+            out = project_out = self.open_file(self.area.target, self.area.path)
         else:
-            print(self.PROJECT_TEMPLATE % self)
-
+            out.writeline(self.PROJECT_TEMPLATE % (self.indent, self.title, self.tags))
         if self.notes:
-            self.print_notes()
+            self.print_notes(out)
 
         if self.uuid == 'NULL':
-            self.find_and_export_items(Task, Task.TASKS_IN_INBOX)
+            rows = self.source.tasks_in_inbox()
         else:
-            self.find_and_export_items(Task, Task.TASKS_IN_PROJECT % self.uuid)
-
-        if self.args.format == RowObject.FMT_PROJECT:
-            sys.stdout = sys.__stdout__
+            rows = self.source.tasks_in_project(self.uuid)
+        return self.children(Task, rows), out, project_out
 
 
 class Task(TaskObjects):
+    __slots__ = ()
 
     TASKS_IN_PROJECT = TaskObjects.task_fields + """
         WHERE type != 1 -- find tasks and action groups
-        AND project="%s"
+        AND project = ?
         AND trashed = 0
         AND status < 2 -- whatever "1" means
+        %s
         ORDER BY type, "index"; -- tasks without headers come first
     """
     TASKS_IN_AREA_WITHOUT_PROJECT = TaskObjects.task_fields + """
         WHERE type != 1 -- find tasks and action groups
-        AND area="%s"
+        AND area = ?
         AND project is NULL
         AND trashed = 0
         AND status < 2 -- whatever "1" means
+        %s
         ORDER BY type, "index"; -- tasks without headers come first
     """
     TASKS_IN_INBOX = TaskObjects.task_fields + """
@@ -296,46 +2847,61 @@ class Task(TaskObjects):
         AND actionGroup IS NULL
         AND trashed = 0
         AND status < 2 -- whatever "1" means
+        %s
         ORDER BY "index";
     """
     TASKS_IN_ACTION_GROUPS = TaskObjects.task_fields + """
         WHERE type = 0
-        AND actionGroup="%s"
+        AND actionGroup = ?
         AND trashed = 0
         AND status < 2 -- whatever "1" means
+        %s
         ORDER BY "index";
     """
+    TASK = 0
+    PROJECT = 1
     ACTIONGROUP = 2
-    TASK_TEMPLATE = '%(indent)s- %(title)s%(tags)s'
-    ACTIONGROUP_TEMPLATE = '%(indent)s%(title)s:'
+    TASK_TEMPLATE = '%s- %s%s'
+    ACTIONGROUP_TEMPLATE = '%s%s:'
 
-    def export(self):
-        logging.debug("Task: %s (%s) Level: %s Status: %s Type: %s", self.title, self.uuid, self.level, self.status, self.type)
+    def visit(self, out):
+        if logging.root.isEnabledFor(logging.DEBUG):  # one check instead of packing the arguments for every task
+            logging.debug("Task: %s (%s) Level: %s Status: %s Type: %s",
+                          self.title, self.uuid, self.level, self.status, self.type)
         self.load_tags_from_db()
         self.add_attributes()
+        self.write(out)
+        if self.type == self.ACTIONGROUP:
+            return self.children(Task, self.source.tasks_in_action_group(self.uuid)), out, None
+        elif self.checklistItemsCount:
+            return self.children(CheckListItem, self.source.checklist_items(self.uuid)), out, None
+        return None
+
+    def write(self, out):
+        """Write the task (or action group) itself, without its children."""
         if self.type == self.ACTIONGROUP:
-            # process action group (which have no notes!)
-            print(self.ACTIONGROUP_TEMPLATE % self)
-            self.find_and_export_items(Task, Task.TASKS_IN_ACTION_GROUPS % self.uuid)
+            # action groups have no notes!
+            out.writeline(self.ACTIONGROUP_TEMPLATE % (self.indent, self.title))
         else:
-            print(self.TASK_TEMPLATE % self)
+            out.writeline(self.TASK_TEMPLATE % (self.indent, self.title, self.tags))
             if self.notes:
-                self.print_notes()
-
-            if self.checkListItemsCount:
-                self.find_and_export_items(CheckListItem, CheckListItem.items_of_task % self.uuid)
+                self.print_notes(out)
 
 
 class CheckListItem(RowObject):
+    __slots__ = ('status',)
+
     items_of_task = """
         SELECT uuid, title, status
         FROM TMChecklistItem
-        WHERE task = '%s'
+        WHERE task = ?
         ORDER BY "index"
     """
+    FIELDS = ('uuid', 'title', 'status')
 
-    def export(self):
-        print(Task.TASK_TEMPLATE % self)
+    def visit(self, out):
+        out.writeline(Task.TASK_TEMPLATE % (self.indent, self.title, ''))
+        return None
 
 
 if __name__ == "__main__":
@@ -349,10 +2915,114 @@ if __name__ == "__main__":
                         help='path to the Things3 database (default: main.sqlite)')
     parser.add_argument('--format', dest='format', action='store',
                         default='project',
-                        help='Define output format(area|project|all): what will be exported into one taskpaper file (default: project')
+                        help='Define output format(area|project|all|jsonl|csv): what will be exported into one taskpaper file, or one record per task and checklist item as JSON lines or CSV (default: project')
     parser.add_argument('--stdout', dest='stdout', action='store_true',
                         default=False,
-                        help='output to standard output instead of file (only works with format=all)')
+                        help='output to standard output instead of file (only works with format=all|jsonl|csv)')
+    parser.add_argument('--engine', dest='engine', action='store',
+                        default=ENGINE_BULK,
+                        help='How to read the database (bulk|query|tree): load every table once, query each node separately, or stream the whole tree from one recursive query (default: bulk)')
+    parser.add_argument('--jobs', dest='jobs', action='store', type=int,
+                        default=1,
+                        help='number of worker processes rendering files in parallel for format area|project (not with engine tree), 0 means one per CPU (default: 1)')
+    parser.add_argument('--archive', dest='archive', action='store',
+                        default=None,
+                        help='write all files into one archive (zip|tar.gz) named after the target, with the same folders and files')
+    parser.add_argument('--perspectives', dest='perspectives', action='store_true',
+                        default=False,
+                        help='also write Today, Upcoming and Someday and a file per tag to a folder "<target> perspectives", collected during the export')
+    parser.add_argument('--search-index', dest='search_index', action='store', nargs='?',
+                        const='', default=None,
+                        help='also write a full-text search index of the exported tasks (titles, notes, tags, areas / projects and files) to SEARCH_INDEX (default: "<target>.search.sqlite"), see --search')
+    parser.add_argument('--no-staging', dest='staging', action='store_false',
+                        default=True,
+                        help='write the files of format area|project into the target folder as they are exported, instead of exporting to a folder next to it that replaces the target folder when the export is complete')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        default=False,
+                        help='only export files whose projects or areas changed since the last export (keeps a manifest next to the target, not with a selection)')
+    parser.add_argument('--profile', dest='profile', action='store', nargs='?',
+                        const='export-profile.json', default=None,
+                        help='profile the export: count and time SQL statements and phases, write a JSON report to PROFILE (default: export-profile.json) and a summary to export.log')
+    parser.add_argument('--profile-memory', dest='profile_memory', action='store_true',
+                        default=False,
+                        help='with --profile, also measure peak memory per phase with tracemalloc (slow)')
+    parser.add_argument('--snapshot', dest='snapshot', action='store',
+                        default=SNAPSHOT_NONE,
+                        help='how to read the database (none|readonly|immutable|memory|file): as it is, read-only, immutable (ignores the -wal file), or from a copy in memory or a temporary file, so Things can stay open (default: none)')
+
+    parser.add_argument('--area', dest='areas', action='append',
+                        default=[],
+                        help='only export this area (may be given several times, combines with --project and --inbox-only)')
+    parser.add_argument('--project', dest='projects', action='append',
+                        default=[],
+                        help='only export this project (may be given several times)')
+    parser.add_argument('--inbox-only', dest='inbox_only', action='store_true',
+                        default=False,
+                        help='only export the inbox (plus the areas and projects given with --area and --project)')
+    parser.add_argument('--tag', dest='tags', action='append',
+                        default=[],
+                        help='only export tasks with this tag, its name in Things or as exported '
+                             '(e.g. "draft notes-0" or @draft_notes_0; may be given several times)')
+    parser.add_argument('--modified-since', dest='modified_since', action='store',
+                        default=None,
+                        help='only export tasks modified on or after this date (YYYY-MM-DD)')
+
+    parser.add_argument('--scratch-indexes', dest='scratch_indexes', action='store_true',
+                        default=False,
+                        help='add indexes for the per-node queries to the copy of the database (needs --snapshot memory|file)')
+    parser.add_argument('--explain', dest='explain', action='store_true',
+                        default=False,
+                        help='print the query plans of the per-node queries instead of exporting')
+
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        default=False,
+                        help='keep running and export again whenever the database changes (works on a copy, see --snapshot memory|file)')
+    parser.add_argument('--watch-interval', dest='watch_interval', action='store', type=float,
+                        default=2.0,
+                        help='seconds between checks for changes of the database with --watch (default: 2)')
+
+    parser.add_argument('--search', dest='search', action='store',
+                        default=None,
+                        help='instead of exporting, print the tasks matching this full-text query (SQLite FTS5 syntax, e.g. "invoice AND tags:urgent") from the search index of the target or --search-index, best matches first')
+    parser.add_argument('--search-limit', dest='search_limit', action='store', type=int,
+                        default=50,
+                        help='maximum number of matches printed by --search (default: 50)')
+
+    parser.add_argument('--batch', dest='batch', action='append',
+                        default=[],
+                        help='export every Things database (main.sqlite or legacy *.sqlite3) in this folder or matching this glob into its own folder below the target, --jobs of them at a time (may be given several times)')
 
     args = parser.parse_args()
-    export(args)
+    if args.batch:
+        sys.exit(1 if batch_export(args) else 0)
+    elif args.search is not None:
+        started = time.perf_counter()
+        path = args.search_index
+        if not path:
+            base, extension = os.path.splitext(args.target)
+            path = SearchIndex.PATH_TMPL % (base if extension in SINGLE_FILE_FORMATS.values() else args.target)
+        matches = search(path, args.search, args.search_limit)
+        for match in matches:
+            print("%s: - %s%s" % (match['file'], match['title'], ' ' + match['tags'] if match['tags'] else ''))
+            print("\t%s" % (match['context'] or 'Inbox'))
+            if match['notes']:
+                print("\t%s" % match['notes'].replace("\n", " "))
+        print("%d matches in %.1f ms" % (len(matches), (time.perf_counter() - started) * 1000), file=sys.stderr)
+    elif args.watch:
+        watch(args)
+    elif args.explain:
+        snapshot = Snapshot(args.database, args.snapshot, scratch_indexes=args.scratch_indexes)
+        con = snapshot.connect()
+        for name, details, full_scan in explain_query_plans(con, Selection(args)):
+            print("%s%s" % (name, ' (full scan)' if full_scan else ''))
+            for detail in details:
+                print("    %s" % detail)
+        con.close()
+        snapshot.close()
+    else:
+        try:
+            export(args)
+        except BrokenPipeError:
+            # the reader of --stdout (e.g. head) went away; don't complain again when stdout is flushed at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
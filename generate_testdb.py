@@ -0,0 +1,318 @@
+import argparse
+import os
+import random
+import sqlite3
+import string
+import time
+
+"""
+Generate synthetic Things 3 databases of configurable size.
+
+The databases contain the tables and indexes the exporter reads (TMArea,
+TMTask, TMTag, TMTaskTag, TMAreaTag, TMChecklistItem), either in the current
+schema (main.sqlite in the thingsdatabase bundle) or in the legacy schema
+used before Things 3.13 (Things.sqlite3), which has fewer TMTask columns and
+wraps notes in <note xml:space="preserve">.
+
+Every database contains an inbox, projects without area, tasks directly in
+areas, projects with and without headers, tagged areas, projects and tasks,
+checklists, notes with links, dates (due, start, today, someday, done) and a
+share of completed, canceled and trashed items.
+"""
+
+SCHEMA_CURRENT = 'current'
+SCHEMA_LEGACY = 'legacy'
+
+TASK_COLUMNS = """
+    'uuid'                 TEXT PRIMARY KEY,
+    'userModificationDate' REAL,
+    'creationDate'         REAL,
+    'trashed'              INTEGER,
+    'type'                 INTEGER,
+    'title'                TEXT,
+    'notes'                TEXT,
+    'dueDate'              REAL,
+    'dueDateOffset'        INTEGER,
+    'status'               INTEGER,
+    'stopDate'             REAL,
+    'start'                INTEGER,
+    'startDate'            REAL,
+    'index'                INTEGER,
+    'todayIndex'           INTEGER,
+    'area'                 TEXT,
+    'project'              TEXT,
+    'repeatingTemplate'    TEXT,
+    'delegate'             TEXT,
+    'recurrenceRule'       BLOB,
+    'instanceCreationStartDate'    REAL,
+    'instanceCreationPaused'       INTEGER,
+    'instanceCreationCount'        INTEGER,
+    'afterCompletionReferenceDate' REAL,
+    'actionGroup' TEXT,
+    'untrashedLeafActionsCount' INTEGER,
+    'openUntrashedLeafActionsCount' INTEGER,
+    'checklistItemsCount' INTEGER,
+    'openChecklistItemsCount' INTEGER,
+    'startBucket' INTEGER,
+    'alarmTimeOffset' REAL,
+    'lastAlarmInteractionDate' REAL,
+    'todayIndexReferenceDate' REAL,
+    'nextInstanceStartDate' REAL,
+    'dueDateSuppressionDate' REAL,
+    'leavesTombstone' INTEGER"""
+
+CURRENT_TASK_COLUMNS = """,
+    'repeater' BLOB,
+    'repeaterMigrationDate' REAL,
+    'repeaterRegularSlotDatesCache' BLOB,
+    'notesSync' INTEGER"""
+
+SCHEMA = """
+    CREATE TABLE 'TMTask' (%s);
+    CREATE INDEX 'index_THMTask_project'    ON 'TMTask'    ('project');
+    CREATE INDEX 'index_THMTask_area'       ON 'TMTask'    ('area');
+    CREATE INDEX 'index_THMTask_start'      ON 'TMTask'    ('start');
+    CREATE INDEX 'index_THMTask_start_type' ON 'TMTask'    ('start', 'type');
+    CREATE INDEX 'index_THMTask_repeatingTemplate' ON 'TMTask' ('repeatingTemplate');
+    CREATE INDEX 'index_THMTask_actionGroup' ON 'TMTask' ('actionGroup');
+    CREATE INDEX 'index_THMTask_stopDate_alarmTimeOffset' ON 'TMTask' ('stopDate', 'alarmTimeOffset');
+    CREATE INDEX 'index_THMTask_type' ON 'TMTask' ('type');
+    CREATE TABLE 'TMTaskTag' ('tasks' TEXT NOT NULL, 'tags' TEXT NOT NULL);
+    CREATE INDEX 'index_THMTaskTag_tasks'   ON 'TMTaskTag' ('tasks');
+    CREATE TABLE 'TMAreaTag' ('areas' TEXT NOT NULL, 'tags' TEXT NOT NULL);
+    CREATE INDEX 'index_THMAreaTag_areas'   ON 'TMAreaTag' ('areas');
+    CREATE TABLE 'TMTag' (
+        'uuid'                 TEXT PRIMARY KEY,
+        'title'                TEXT,
+        'shortcut'             TEXT,
+        'usedDate'             REAL,
+        'parent'               TEXT,
+        'index'                INTEGER);
+    CREATE TABLE 'TMArea' (
+        'uuid'                 TEXT PRIMARY KEY,
+        'title'                TEXT,
+        'visible'              INTEGER,
+        'index'                INTEGER);
+    CREATE TABLE 'TMChecklistItem' (
+        'uuid'                 TEXT PRIMARY KEY,
+        'userModificationDate' REAL,
+        'creationDate'         REAL,
+        'title'                TEXT,
+        'status'               INTEGER,
+        'stopDate'             REAL,
+        'index'                INTEGER,
+        'task'                 TEXT,
+        'leavesTombstone' INTEGER);
+    CREATE INDEX 'index_THMChecklistItem_task' ON 'TMChecklistItem' ('task');
+"""
+
+INSERT_TASK = """
+    INSERT INTO TMTask (uuid, userModificationDate, creationDate, trashed, type, title, notes,
+                        dueDate, status, stopDate, start, startDate, "index", todayIndex,
+                        area, project, actionGroup, checklistItemsCount, openChecklistItemsCount)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+"""
+INSERT_CHECKLIST_ITEM = """
+    INSERT INTO TMChecklistItem (uuid, userModificationDate, creationDate, title, status, stopDate, "index", task)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+"""
+
+WORDS = """
+    call email buy read write review plan book fix clean prepare check order
+    send update draft sort organize cancel renew pay meet ask invite print
+    report budget invoice garden kitchen car office travel dentist taxes
+    website backup notes ideas research article podcast newsletter birthday
+""".split()
+
+URLS = [
+    'https://culturedcode.com/things/support/articles/2982272/',
+    'https://www.taskpaper.com/guide/',
+    'https://example.com/some/longer/path?with=query&and=more',
+]
+
+TASK = 0
+PROJECT = 1
+ACTIONGROUP = 2
+
+
+class Generator(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.now = time.time()
+        self.tasks = []
+        self.checklist_items = []
+        self.task_tags = []
+        self.area_tags = []
+
+    def uuid(self):
+        return ''.join(self.random.choice(string.ascii_letters + string.digits) for _ in range(22))
+
+    def title(self):
+        words = self.random.sample(WORDS, self.random.randint(2, 5))
+        return ' '.join(words).capitalize()
+
+    def date(self, days=60):
+        return self.now + self.random.uniform(-days, days) * 86400
+
+    def notes(self):
+        if not self.args.note_length or self.random.random() > 0.3:
+            return ''
+        lines = []
+        length = 0
+        while length < self.args.note_length:
+            if self.random.random() < 0.1:
+                url = self.random.choice(URLS)
+                if self.args.schema == SCHEMA_LEGACY:
+                    line = 'see <a href="%s">%s</a>' % (url, url)
+                else:
+                    line = 'see %s' % url
+            else:
+                line = ' '.join(self.random.choice(WORDS) for _ in range(self.random.randint(3, 12)))
+            lines.append(line)
+            length += len(line) + 1
+        notes = '\n'.join(lines)[:self.args.note_length] + '\n'
+        if self.args.schema == SCHEMA_LEGACY:
+            notes = '<note xml:space="preserve">%s</note>' % notes
+        return notes
+
+    def add_task(self, type_, area=None, project=None, action_group=None):
+        uuid = self.uuid()
+        r = self.random.random()
+        status = 3 if r < 0.1 else 2 if r < 0.13 else 0
+        trashed = 1 if self.random.random() < 0.03 else 0
+        due = self.date() if self.random.random() < 0.1 else None
+        start = start_date = today_index = None
+        r = self.random.random()
+        if r < 0.1:
+            start, start_date, today_index = 1, self.date(0), self.random.randint(1, 1000)  # today
+        elif r < 0.15:
+            start, today_index = 2, self.random.randint(1, 1000)  # someday
+        elif r < 0.25:
+            start, start_date = 2, self.date()
+        stop_date = self.date() if status else None
+        checklist = 0
+        if type_ == TASK and self.args.checklist and self.random.random() < 0.2:
+            checklist = self.random.randint(1, self.args.checklist)
+            for index in range(checklist):
+                self.checklist_items.append((self.uuid(), self.date(), self.date(), self.title(),
+                                             0, None, self.random.randint(-1000, 1000), uuid))
+        title = self.title()
+        if self.random.random() < 0.01:
+            title = "%s's \"quoted\" %s" % (title, self.title().lower())
+        self.tasks.append((uuid, self.date(), self.date(), trashed, type_, title,
+                           self.notes() if type_ != ACTIONGROUP else '',
+                           due, status, stop_date, start, start_date, self.random.randint(-2000, 2000), today_index,
+                           area, project, action_group, checklist, checklist))
+        if type_ != ACTIONGROUP:
+            for tag in self.random.sample(self.tags, min(self.random.randint(0, 2 * self.args.tags_per_task),
+                                                         len(self.tags))):
+                self.task_tags.append((uuid, tag))
+        return uuid
+
+    def add_project(self, area=None):
+        project = self.add_task(PROJECT, area=area)
+        for _ in range(self.args.tasks):
+            self.add_task(TASK, project=project)
+        for _ in range(self.args.headers):
+            heading = self.add_task(ACTIONGROUP, project=project)
+            for _ in range(self.args.tasks):
+                # tasks under a heading only refer to the heading
+                self.add_task(TASK, action_group=heading)
+
+    def generate(self, con):
+        columns = TASK_COLUMNS
+        if self.args.schema == SCHEMA_CURRENT:
+            columns += CURRENT_TASK_COLUMNS
+        con.executescript(SCHEMA % columns)
+
+        tags = []
+        for index in range(self.args.tags):
+            title = '%s %s-%d' % (self.random.choice(WORDS), self.random.choice(WORDS), index)
+            tags.append((self.uuid(), title, None, None, None, index))
+        self.tags = [tag[0] for tag in tags]
+
+        areas = []
+        for index in range(self.args.areas):
+            area = self.uuid()
+            areas.append((area, 'Area %d %s' % (index, self.title()), 1, index))
+            for tag in self.random.sample(self.tags, min(self.random.randint(0, 2), len(self.tags))):
+                self.area_tags.append((area, tag))
+            for _ in range(self.args.tasks):
+                self.add_task(TASK, area=area)
+            for _ in range(self.args.projects):
+                self.add_project(area)
+        for _ in range(self.args.projects):
+            self.add_project()
+        for _ in range(self.args.tasks):
+            self.add_task(TASK)  # inbox
+
+        with con:
+            con.executemany("INSERT INTO TMTag VALUES (?, ?, ?, ?, ?, ?);", tags)
+            con.executemany("INSERT INTO TMArea VALUES (?, ?, ?, ?);", areas)
+            con.executemany(INSERT_TASK, self.tasks)
+            con.executemany(INSERT_CHECKLIST_ITEM, self.checklist_items)
+            con.executemany("INSERT INTO TMTaskTag VALUES (?, ?);", self.task_tags)
+            con.executemany("INSERT INTO TMAreaTag VALUES (?, ?);", self.area_tags)
+        return len(self.tasks)
+
+
+def generate(args):
+    if os.path.exists(args.target):
+        os.remove(args.target)
+    con = sqlite3.connect(args.target)
+    count = Generator(args).generate(con)
+    con.close()
+    return count
+
+
+def generator_args(**kwargs):
+    """Return the default generator arguments, updated with kwargs."""
+    args = parser().parse_args([])
+    vars(args).update(kwargs)
+    return args
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Things 3 database for tests and benchmarks.')
+    parser.add_argument('--target', dest='target', action='store',
+                        default='Things-generated.sqlite',
+                        help='database file to create, an existing file is replaced (default: Things-generated.sqlite)')
+    parser.add_argument('--schema', dest='schema', action='store',
+                        default=SCHEMA_CURRENT,
+                        help='database schema (current|legacy): Things 3.13+ or before (default: current)')
+    parser.add_argument('--areas', dest='areas', action='store', type=int,
+                        default=5,
+                        help='number of areas (default: 5)')
+    parser.add_argument('--projects', dest='projects', action='store', type=int,
+                        default=5,
+                        help='projects per area, and projects without area (default: 5)')
+    parser.add_argument('--headers', dest='headers', action='store', type=int,
+                        default=2,
+                        help='headers per project (default: 2)')
+    parser.add_argument('--tasks', dest='tasks', action='store', type=int,
+                        default=10,
+                        help='tasks per project, header and area, and tasks in the inbox (default: 10)')
+    parser.add_argument('--tags', dest='tags', action='store', type=int,
+                        default=20,
+                        help='number of tags (default: 20)')
+    parser.add_argument('--tags-per-task', dest='tags_per_task', action='store', type=int,
+                        default=1,
+                        help='average number of tags per task (default: 1)')
+    parser.add_argument('--checklist', dest='checklist', action='store', type=int,
+                        default=5,
+                        help='maximum number of checklist items of tasks with checklist (default: 5)')
+    parser.add_argument('--note-length', dest='note_length', action='store', type=int,
+                        default=300,
+                        help='length of notes in characters, 0 for no notes (default: 300)')
+    parser.add_argument('--seed', dest='seed', action='store', type=int,
+                        default=0,
+                        help='random seed (default: 0)')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    count = generate(args)
+    print("generated %s with %d tasks" % (args.target, count))